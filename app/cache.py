@@ -0,0 +1,124 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # LRU cache whose entries also expire after ttl seconds, keys are tuples
+    # starting with the index name so a reloaded index can be dropped.
+    # With maxbytes the sizes given to set() are bounded as well
+    def __init__(self, maxsize=512, ttl=300, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value, _ = item
+        if expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __contains__(self, key):
+        # doesn't count as a hit or miss
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def set(self, key, value, size=0):
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + self.ttl, value, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.bytes > self.maxbytes):
+            self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        _, value, size = self._data.pop(key)
+        self.bytes -= size
+        self.removed(key, value)
+
+    def removed(self, key, value):
+        # called for every entry leaving the cache
+        pass
+
+    def invalidate(self, index=None):
+        if index is None:
+            keys = list(self._data)
+        else:
+            keys = [key for key in self._data if key[0] == index]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PageCache(TTLCache):
+    # listing pages fetched ahead of the request, a page that leaves the
+    # cache without being read was a wasted prefetch
+    def __init__(self, maxsize=1024, ttl=30, maxbytes=None):
+        super().__init__(maxsize, ttl, maxbytes)
+        self.stored = 0
+        self.used = 0
+        self.wasted = 0
+        self._unread = set()
+
+    def set(self, key, value, size=0):
+        super().set(key, value, size)
+        self.stored += 1
+        self._unread.add(key)
+
+    def get(self, key):
+        value = super().get(key)
+        if value is not None and key in self._unread:
+            self._unread.discard(key)
+            self.used += 1
+        return value
+
+    def removed(self, key, value):
+        if key in self._unread:
+            self._unread.discard(key)
+            self.wasted += 1
+
+
+class SingleFlight:
+    # concurrent callers with the same key share one in-flight call
+    def __init__(self):
+        # hits joined a call already in flight, misses started a new one
+        self.hits = 0
+        self.misses = 0
+        self._calls = dict()
+
+    async def do(self, key, func):
+        future = self._calls.get(key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(func())
+            self._calls[key] = future
+            future.add_done_callback(
+                lambda done: self._forget(key, done))
+        else:
+            self.hits += 1
+        # shielded so a disconnecting client doesn't cancel the call for
+        # everybody waiting on it
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
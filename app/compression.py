@@ -0,0 +1,142 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from starlette.datastructures import Headers, MutableHeaders
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/x-ndjson")
+
+
+def accepted_encodings(accept_encoding):
+    # "gzip, br;q=0.9, *;q=0" -> {"gzip": 1.0, "br": 0.9, "*": 0.0}
+    encodings = dict()
+    for item in accept_encoding.split(","):
+        encoding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if encoding:
+            encodings[encoding.lower()] = quality
+    return encodings
+
+
+def choose_encoding(accept_encoding):
+    encodings = accepted_encodings(accept_encoding)
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best = None
+    best_quality = 0.0
+    for encoding in candidates:
+        quality = encodings.get(encoding, encodings.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Compressor:
+    def __init__(self, encoding, gzip_level, brotli_quality):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits 31 writes the gzip header and trailer
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class CompressionMiddleware:
+    # gzip/brotli for JSON and CSV responses, works on streamed bodies too
+    def __init__(self, app, minimum_size=1024, gzip_level=6,
+                 brotli_quality=4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(
+            Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = CompressionResponder(
+            send, Compressor(encoding, self.gzip_level, self.brotli_quality),
+            self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    def __init__(self, send, compressor, minimum_size):
+        self._send = send
+        self.compressor = compressor
+        self.minimum_size = minimum_size
+        self.start_message = None
+        # None until the first body message decides it
+        self.compressing = None
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            # held back until we know whether the body gets compressed
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressing is None:
+            headers = Headers(raw=self.start_message["headers"])
+            content_type = headers.get("content-type", "")
+            # ranged responses address bytes of the stored file, compressing
+            # them would break resumed downloads
+            self.compressing = (
+                "content-encoding" not in headers
+                and "accept-ranges" not in headers
+                and content_type.startswith(COMPRESSIBLE_TYPES)
+                and (more_body or len(body) >= self.minimum_size))
+            if self.compressing:
+                headers = MutableHeaders(raw=self.start_message["headers"])
+                headers["Content-Encoding"] = self.compressor.encoding
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+                body = self.compressor.compress(body)
+                if more_body:
+                    del headers["content-length"]
+                else:
+                    body += self.compressor.finish()
+                    headers["Content-Length"] = str(len(body))
+                await self._send(self.start_message)
+                await self._send({"type": "http.response.body",
+                                  "body": body, "more_body": more_body})
+                return
+            await self._send(self.start_message)
+
+        if not self.compressing:
+            await self._send(message)
+            return
+
+        body = self.compressor.compress(body)
+        if not more_body:
+            body += self.compressor.finish()
+        if body or not more_body:
+            await self._send({"type": "http.response.body", "body": body,
+                              "more_body": more_body})
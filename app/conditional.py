@@ -0,0 +1,73 @@
+import hashlib
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.datastructures import Headers, MutableHeaders
+
+
+def normalized_query(query_string):
+    # parameter order doesn't change the response
+    return urlencode(sorted(parse_qsl(query_string.decode("latin-1"),
+                                      keep_blank_values=True)))
+
+
+def make_etag(version, path, query, accept_encoding, salt=""):
+    # strong validator, so it has to differ per content encoding as well
+    digest = hashlib.sha1(
+        f"{salt}|{version}|{path}|{query}|{accept_encoding}".encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ETagMiddleware:
+    # ETags for GET requests on an index, built from the index version and
+    # the normalized request. A matching If-None-Match is answered with 304
+    # before the endpoint runs, so revalidations cost no ES call
+    def __init__(self, app, index_version, cache_control="no-cache", salt=""):
+        self.app = app
+        # index name -> current version, None for paths that aren't an index
+        # or whose version isn't known
+        self.index_version = index_version
+        self.cache_control = cache_control
+        self.salt = salt
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+        version = self.index_version(scope["path"].strip("/").split("/")[0])
+        if version is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        etag = make_etag(version, scope["path"],
+                         normalized_query(scope["query_string"]),
+                         headers.get("accept-encoding", ""), self.salt)
+        validators = [(b"etag", etag.encode()),
+                      (b"cache-control", self.cache_control.encode()),
+                      (b"vary", b"Accept-Encoding")]
+        if etag_matches(headers.get("if-none-match", ""), etag):
+            await send({"type": "http.response.start", "status": 304,
+                        "headers": validators})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start" and \
+                    message["status"] == 200:
+                response_headers = MutableHeaders(raw=message["headers"])
+                if "etag" not in response_headers:
+                    response_headers["ETag"] = etag
+                    response_headers["Cache-Control"] = self.cache_control
+                    response_headers.add_vary_header("Accept-Encoding")
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
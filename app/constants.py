@@ -6,4 +6,45 @@ DATA_PORTAL_AGGREGATIONS = [
     "images_available"
 ]
 
-ARTICLES_AGGREGATIONS = ["pubYear", "journalTitle", "articleType"]
\ No newline at end of file
+ARTICLES_AGGREGATIONS = ["pubYear", "journalTitle", "articleType"]
+# nested record arrays of a data_portal organism -> name of their facet aggregation
+NESTED_RECORDS = {
+    "records": "metadata_filters",
+    "symbionts_records": "symbionts_filters",
+    "metagenomes_records": "metagenomes_filters"
+}
+
+# filterable fields of the nested records -> name of their terms aggregation
+NESTED_RECORDS_FILTERS = {
+    "sex": "sex_filter",
+    "trackingSystem": "tracking_status_filter",
+    "organismPart": "organism_part_filter"
+}
+
+# sortable fields of the nested records -> field ES sorts on
+NESTED_RECORDS_SORT_FIELDS = dict(
+    {"accession": "accession.keyword"},
+    **{field: f"{field}.keyword" for field in NESTED_RECORDS_FILTERS})
+
+# _source fields read by the export for a download option, per index type
+# (None matches any index)
+EXPORT_SOURCE_FIELDS = {
+    ("assemblies", None): ["organism", "assemblies"],
+    ("annotation", None): ["annotation"],
+    ("raw_files", None): ["experiment"],
+    ("metadata", "data_portal"): [
+        "organism", "commonName", "commonNameSource", "currentStatus",
+        "tolid", "experiment.study_accession"
+    ],
+    ("metadata", "tracking_status"): [
+        "organism", "commonName", "biosamples", "raw_data", "mapped_reads",
+        "assemblies_status", "annotation_complete", "annotation_status"
+    ]
+}
+
+# ranks of the phylogeny browser, from the root of the tree down, the same
+# ranks current_class steps through. The taxonomies object has more of them
+# (superkingdom, subphylum, ...) but each document only has some
+TAXONOMY_RANKS = [
+    "kingdom", "phylum", "class", "order", "family", "genus", "species"
+]
@@ -0,0 +1,32 @@
+import base64
+import binascii
+import hashlib
+
+import orjson
+
+
+def cursor_binding(plan, sort):
+    # a cursor is only valid for the query and sort it was issued for
+    return hashlib.sha1(f"{plan.key}|{sort or ''}".encode()).hexdigest()[:16]
+
+
+def encode_cursor(binding, offset, pit_id=None, search_after=None):
+    # o: offset of the page, p/a: point-in-time and sort values of the
+    # last hit once the listing has switched to search_after
+    state = {"k": binding, "o": offset}
+    if pit_id is not None:
+        state["p"] = pit_id
+        state["a"] = search_after
+    return base64.urlsafe_b64encode(orjson.dumps(state)).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        state = orjson.loads(base64.urlsafe_b64decode(
+            token + "=" * (-len(token) % 4)))
+    except (binascii.Error, orjson.JSONDecodeError, ValueError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(state, dict) or not isinstance(state.get("k"), str) \
+            or not isinstance(state.get("o"), int) or state["o"] < 0:
+        raise ValueError("Malformed cursor")
+    return state
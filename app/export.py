@@ -0,0 +1,433 @@
+import asyncio
+import collections
+import csv
+import gzip
+import io
+import logging
+
+import orjson
+from elasticsearch import NotFoundError
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .constants import EXPORT_SOURCE_FIELDS
+from .log import debug_sampled
+from .metrics import EXPORT_BYTES, EXPORT_ROWS
+from .query import parse_sort
+
+logger = logging.getLogger(__name__)
+
+# how long ES keeps the point-in-time alive between two batches
+PIT_KEEP_ALIVE = '5m'
+# gzipped exports favour speed, the batches are compressed independently
+EXPORT_GZIP_LEVEL = 6
+
+# format -> (media type, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'csv.gz': ('application/gzip', '.csv.gz'),
+    'tsv': ('text/tab-separated-values', '.tsv'),
+    'tsv.gz': ('application/gzip', '.tsv.gz'),
+    'jsonl': ('application/x-ndjson', '.jsonl'),
+    'jsonl.gz': ('application/gzip', '.jsonl.gz'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+}
+DELIMITERS = {'csv': ',', 'tsv': '\t'}
+
+
+def available_export_formats():
+    # parquet needs the optional pyarrow
+    return [name for name in EXPORT_FORMATS
+            if name != 'parquet' or pyarrow is not None]
+
+
+def export_source_fields(download_option, index_name):
+    # None means the full _source is needed
+    download_option = download_option.lower()
+    for index_type in ('data_portal', 'tracking_status'):
+        if index_type in index_name and \
+                (download_option, index_type) in EXPORT_SOURCE_FIELDS:
+            return EXPORT_SOURCE_FIELDS[(download_option, index_type)]
+    return EXPORT_SOURCE_FIELDS.get((download_option, None))
+
+
+async def fetch_data_in_batches(es, index, query, sort=None,
+                                batch_size=1000, source=None):
+    pit = await es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+    pit_id = pit['id']
+    search_after = None
+    try:
+        while True:
+            body = {
+                "size": batch_size,
+                "pit": {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE},
+                # _shard_doc is the cheapest unique tiebreaker for a PIT
+                "sort": parse_sort(sort) + [{"_shard_doc": "asc"}],
+                "track_total_hits": False
+            }
+            if query:
+                body["query"] = query
+            if source is not None:
+                body["_source"] = source
+            if search_after:
+                body["search_after"] = search_after
+
+            response = await es.search(body=body)
+            pit_id = response.get('pit_id', pit_id)
+            results = response['hits']['hits']
+            if not results:
+                break
+
+            yield results
+            debug_sampled(logger, "Fetched %d results from %s",
+                          len(results), index)
+            if len(results) < batch_size:
+                break
+            search_after = results[-1]['sort']
+    finally:
+        try:
+            await es.close_point_in_time(body={"id": pit_id})
+        except NotFoundError:
+            # already expired on the ES side
+            pass
+
+
+async def fetch_data_in_slices(es, index, query, sort=None, slices=4,
+                               concurrency=4, batch_size=1000,
+                               queue_size=2, source=None):
+    pit = await es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+    pit_id = pit['id']
+    semaphore = asyncio.Semaphore(concurrency)
+    # bounded queues keep at most queue_size batches per slice in memory
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in range(slices)]
+
+    async def fetch_slice(slice_id):
+        slice_pit_id = pit_id
+        search_after = None
+        try:
+            while True:
+                body = {
+                    "size": batch_size,
+                    "pit": {"id": slice_pit_id, "keep_alive": PIT_KEEP_ALIVE},
+                    "slice": {"id": slice_id, "max": slices},
+                    "sort": parse_sort(sort) + [{"_shard_doc": "asc"}],
+                    "track_total_hits": False
+                }
+                if query:
+                    body["query"] = query
+                if source is not None:
+                    body["_source"] = source
+                if search_after:
+                    body["search_after"] = search_after
+
+                async with semaphore:
+                    response = await es.search(body=body)
+                slice_pit_id = response.get('pit_id', slice_pit_id)
+                results = response['hits']['hits']
+                if not results:
+                    break
+
+                await queues[slice_id].put(results)
+                if len(results) < batch_size:
+                    break
+                search_after = results[-1]['sort']
+        except Exception as e:
+            await queues[slice_id].put(e)
+        else:
+            await queues[slice_id].put(None)
+
+    tasks = [asyncio.create_task(fetch_slice(slice_id))
+             for slice_id in range(slices)]
+    try:
+        # batches are taken round-robin in slice order, so the output order
+        # only depends on the PIT and not on which slice answered first
+        active = list(range(slices))
+        while active:
+            for slice_id in list(active):
+                results = await queues[slice_id].get()
+                if results is None:
+                    active.remove(slice_id)
+                    continue
+                if isinstance(results, Exception):
+                    raise results
+                yield results
+                debug_sampled(logger, "Fetched %d results from slice %d of %s",
+                              len(results), slice_id, index)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await es.close_point_in_time(body={"id": pit_id})
+        except NotFoundError:
+            pass
+
+
+async def prepend_batch(first_batch, batches):
+    yield first_batch
+    async for batch in batches:
+        yield batch
+
+
+def csv_header(download_option, index_name):
+    header = []
+    if download_option.lower() == "assemblies":
+        header = ["Scientific Name", "Accession", "Version", "Assembly Name", "Assembly Description",
+                  "Link to chromosomes, contigs and scaffolds all in one"]
+    elif download_option.lower() == "annotation":
+        header = ["Annotation GTF", "Annotation GFF3", "Proteins Fasta", "Transcripts Fasta",
+                  "Softmasked genomes Fasta"]
+    elif download_option.lower() == "raw_files":
+        header = ["Study Accession", "Sample Accession", "Experiment Accession", "Run Accession", "Tax Id",
+                  "Scientific Name", "FASTQ FTP", "Submitted FTP", "SRA FTP", "Library Construction Protocol"]
+    elif download_option.lower() == "metadata" and 'data_portal' in index_name:
+        header = ['Organism', 'Common Name', 'Common Name Source', 'Current Status','INSDC ID', 'ToL ID']
+    elif download_option.lower() == "metadata" and 'tracking_status' in index_name:
+        header = ['Organism', 'Common Name', 'Metadata submitted to BioSamples', 'Raw data submitted to ENA',
+                  'Mapped reads submitted to ENA', 'Assemblies submitted to ENA',
+                  'Annotation complete', 'Annotation submitted to ENA']
+    return header
+
+
+def extract_rows(batch, download_option, index_name):
+    # rows of the download option, in the order of csv_header, shared by
+    # every export format
+    for entry in batch:
+        INSDC_ID = ''
+        tolid_str = ''
+        record = entry["_source"]
+        if download_option.lower() == "assemblies":
+            assemblies = record.get("assemblies", [])
+            scientific_name = record.get("organism", "")
+            for assembly in assemblies:
+                accession = assembly.get("accession", "-")
+                version = assembly.get("version", "-")
+                assembly_name = assembly.get("assembly_name", "")
+                assembly_description = assembly.get("description", "")
+                link = f"https://www.ebi.ac.uk/ena/browser/api/fasta/{accession}?download=true&gzip=true" if accession else ""
+                entry = [scientific_name, accession, version, assembly_name, assembly_description, link]
+                yield entry
+
+        elif download_option.lower() == "annotation":
+            annotations = record.get("annotation", [])
+            debug_sampled(logger, "%d annotations for %s",
+                          len(annotations), record.get("organism"))
+            for annotation in annotations:
+                gtf = annotation.get("annotation", {}).get("GTF", "-")
+                gff3 = annotation.get("annotation", {}).get("GFF3", "-")
+                proteins_fasta = annotation.get("proteins", {}).get("FASTA", "")
+                transcripts_fasta = annotation.get("transcripts", {}).get("FASTA", "")
+                softmasked_genomes_fasta = annotation.get("softmasked_genome", {}).get("FASTA", "")
+                entry = [gtf, gff3, proteins_fasta, transcripts_fasta, softmasked_genomes_fasta]
+                yield entry
+
+        elif download_option.lower() == "raw_files":
+            experiments = record.get("experiment", [])
+            for experiment in experiments:
+                study_accession = experiment.get("study_accession", "")
+                sample_accession = experiment.get("sample_accession", "")
+                experiment_accession = experiment.get("experiment_accession", "")
+                run_accession = experiment.get("run_accession", "")
+                tax_id = experiment.get("tax_id", "")
+                scientific_name = experiment.get("scientific_name", "")
+                submitted_ftp = experiment.get("submitted_ftp", "")
+                sra_ftp = experiment.get("sra-ftp", "")
+                library_construction_protocol = experiment.get("library_construction_protocol", "")
+                fastq_ftp = experiment.get("fastq_ftp", "")
+
+                if fastq_ftp:
+                    fastq_list = fastq_ftp.split(";")
+                    for fastq in fastq_list:
+                        entry = [study_accession, sample_accession, experiment_accession, run_accession, tax_id,
+                                 scientific_name, fastq, submitted_ftp, sra_ftp, library_construction_protocol]
+                        yield entry
+                else:
+                    entry = [study_accession, sample_accession, experiment_accession, run_accession, tax_id,
+                             scientific_name, fastq_ftp, submitted_ftp, sra_ftp, library_construction_protocol]
+                    yield entry
+
+        elif download_option.lower() == "metadata" and 'data_portal' in index_name:
+            organism = record.get('organism', '')
+            common_name = record.get('commonName', '')
+            common_name_source = record.get('commonNameSource', '')
+            current_status = record.get('currentStatus', '')
+            tolids = record.get('tolid', [])
+            debug_sampled(logger, "ToL IDs of %s: %s", organism, tolids)
+            if tolids:
+                tolid_str = ", ".join(map(str, tolids))
+            experiments = record.get("experiment", [])
+            if experiments:
+                INSDC_ID = experiments[0].get("study_accession", "")
+            entry = [organism, common_name, common_name_source, current_status, INSDC_ID, tolid_str]
+            yield entry
+
+        elif download_option.lower() == "metadata" and 'tracking_status' in index_name:
+            organism = record.get('organism', '')
+            common_name = record.get('commonName', '')
+            metadata_biosamples = record.get('biosamples', '')
+            raw_data_ena = record.get('raw_data', '')
+            mapped_reads_ena = record.get('mapped_reads', '')
+            assemblies_ena = record.get('assemblies_status', '')
+            annotation_complete = record.get('annotation_complete', '')
+            annotation_submitted_ena = record.get('annotation_status', '')
+            entry = [organism, common_name, metadata_biosamples, raw_data_ena, mapped_reads_ena, assemblies_ena,
+                     annotation_complete, annotation_submitted_ena]
+            yield entry
+
+
+def encode_delimited(rows, delimiter):
+    output = io.StringIO()
+    csv.writer(output, delimiter=delimiter).writerows(rows)
+    return output.getvalue().encode('utf-8')
+
+
+def encode_parquet_batch(rows, header):
+    # every column is a string column, the values are what the CSV shows
+    columns = list(zip(*rows)) if rows else [()] * len(header)
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array([None if value is None else str(value)
+                        for value in column], type=pyarrow.string())
+         for column in columns],
+        names=header)
+
+
+def encode_batch(batch, download_option, index_name, export_format):
+    # runs in the export workers, returns the encoded batch and its rows
+    rows = list(extract_rows(batch, download_option, index_name))
+    base, _, compression = export_format.partition('.')
+    if base == 'parquet':
+        return encode_parquet_batch(
+            rows, csv_header(download_option, index_name)), len(rows)
+    if base == 'jsonl':
+        header = csv_header(download_option, index_name)
+        data = b''.join(orjson.dumps(dict(zip(header, row))) + b'\n'
+                        for row in rows)
+    else:
+        data = encode_delimited(rows, DELIMITERS[base])
+    if compression == 'gz' and data:
+        # every batch is its own gzip member, concatenated members are
+        # still one valid gzip file
+        data = gzip.compress(data, compresslevel=EXPORT_GZIP_LEVEL)
+    return data, len(rows)
+
+
+class ChunkSink(io.RawIOBase):
+    # file object for the parquet writer, written bytes are handed out with
+    # drain() while tell() keeps counting for the footer offsets
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class ExportWriter:
+    # header, encoded batches and trailer of one export in order
+    def __init__(self, download_option, index_name, export_format):
+        self.header = csv_header(download_option, index_name)
+        self.export_format = export_format
+
+    def start(self):
+        base, _, compression = self.export_format.partition('.')
+        if base == 'jsonl':
+            return b''
+        data = encode_delimited([self.header], DELIMITERS[base])
+        if compression == 'gz':
+            data = gzip.compress(data, compresslevel=EXPORT_GZIP_LEVEL)
+        return data
+
+    def write(self, encoded):
+        return encoded
+
+    def finish(self):
+        return b''
+
+
+class ParquetWriter(ExportWriter):
+    def start(self):
+        self.sink = ChunkSink()
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.sink, pyarrow.schema([(name, pyarrow.string())
+                                       for name in self.header]),
+            compression='snappy')
+        return self.sink.drain()
+
+    def write(self, encoded):
+        # one row group per batch
+        if encoded.num_rows:
+            self.writer.write_batch(encoded)
+        return self.sink.drain()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.drain()
+
+
+def export_writer(download_option, index_name, export_format):
+    if export_format == 'parquet':
+        return ParquetWriter(download_option, index_name, export_format)
+    return ExportWriter(download_option, index_name, export_format)
+
+
+async def create_data_files(batches, download_option, index_name,
+                            export_format='csv', executor=None,
+                            max_pending=4):
+    rows_total = EXPORT_ROWS.labels(download_option.lower())
+    bytes_total = EXPORT_BYTES.labels(download_option.lower())
+    writer = export_writer(download_option, index_name, export_format)
+
+    def output(encoded, rows):
+        chunk = writer.write(encoded)
+        rows_total.inc(rows)
+        bytes_total.inc(len(chunk))
+        return chunk
+
+    yield writer.start()
+
+    if executor is None:
+        # rows of one batch are flushed at once so memory stays bounded
+        # by one batch
+        async for batch in batches:
+            yield output(*encode_batch(batch, download_option, index_name,
+                                       export_format))
+    else:
+        # encoding batches in the worker pool, results are still yielded in
+        # the order the batches arrived
+        loop = asyncio.get_running_loop()
+        pending = collections.deque()
+        try:
+            async for batch in batches:
+                pending.append(loop.run_in_executor(
+                    executor, encode_batch, batch, download_option,
+                    index_name, export_format))
+                if len(pending) >= max_pending:
+                    yield output(*await pending.popleft())
+            while pending:
+                yield output(*await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+    trailer = writer.finish()
+    if trailer:
+        bytes_total.inc(len(trailer))
+        yield trailer
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+RUNNING = ('queued', 'running')
+
+
+class ExportJob:
+    def __init__(self, key, spool_dir, extension='.csv',
+                 media_type='text/csv'):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.extension = extension
+        self.media_type = media_type
+        self.path = os.path.join(spool_dir, self.id + extension)
+        self.status = 'queued'
+        self.documents = 0
+        self.total = None
+        self.size = 0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+
+    def to_dict(self):
+        if self.status == 'done':
+            progress = 1.0
+        elif self.total:
+            progress = round(min(self.documents / self.total, 1.0), 4)
+        else:
+            progress = 0.0
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'progress': progress,
+            'documents': self.documents,
+            'total': self.total,
+            'bytes': self.size,
+            'created': self.created,
+            'finished': self.finished,
+        }
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+
+class ExportJobs:
+    # exports running in the background and written to a spool directory,
+    # an export identical to a running or recently finished one reuses it
+    def __init__(self, spool_dir, concurrency=2, reuse_age=600,
+                 max_age=21600, max_bytes=2 * 1024 ** 3):
+        self.spool_dir = spool_dir
+        self.concurrency = concurrency
+        self.reuse_age = reuse_age
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.jobs = dict()
+        # key -> latest job for that export
+        self.by_key = dict()
+        self.semaphore = None
+
+    def start(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        # files left behind by earlier runs can't be looked up any more,
+        # they are dropped once they are as old as an expired job
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            if os.path.isfile(path) and \
+                    time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+
+    async def close(self):
+        tasks = [job.task for job in self.jobs.values()
+                 if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def queued(self):
+        return sum(1 for job in self.jobs.values() if job.status == 'queued')
+
+    def submit(self, key, run, extension='.csv', media_type='text/csv'):
+        # run(job) is an async generator of the file's chunks, returns the
+        # job and whether it was created by this call
+        self.evict()
+        job = self.by_key.get(key)
+        if job is not None and (job.status in RUNNING or (
+                job.status == 'done'
+                and time.time() - job.finished < self.reuse_age)):
+            return job, False
+        job = ExportJob(key, self.spool_dir, extension, media_type)
+        self.jobs[job.id] = job
+        self.by_key[key] = job
+        job.task = asyncio.ensure_future(self._run(job, run))
+        return job, True
+
+    async def _run(self, job, run):
+        loop = asyncio.get_running_loop()
+        part = job.path + '.part'
+        try:
+            async with self.semaphore:
+                job.status = 'running'
+                with open(part, 'wb') as f:
+                    async for chunk in run(job):
+                        await loop.run_in_executor(None, f.write, chunk)
+                        job.size += len(chunk)
+                os.replace(part, job.path)
+                job.status = 'done'
+        except asyncio.CancelledError:
+            job.status = 'failed'
+            job.error = 'cancelled'
+            raise
+        except Exception as e:
+            logger.exception("Export job %s failed", job.id)
+            job.status = 'failed'
+            job.error = str(e) or e.__class__.__name__
+        finally:
+            job.finished = time.time()
+            if job.status != 'done' and os.path.exists(part):
+                os.remove(part)
+        self.evict()
+
+    def evict(self):
+        # finished jobs expire after max_age, the oldest files are dropped
+        # first while the spool is above max_bytes
+        now = time.time()
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished is not None),
+            key=lambda job: job.finished)
+        spooled = sum(job.size for job in finished if job.status == 'done')
+        for job in finished:
+            expired = now - job.finished > self.max_age
+            if not expired and not (job.status == 'done'
+                                    and spooled > self.max_bytes):
+                continue
+            if job.status == 'done':
+                spooled -= job.size
+            self._remove(job)
+
+    def _remove(self, job):
+        del self.jobs[job.id]
+        if self.by_key.get(job.key) is job:
+            del self.by_key[job.key]
+        # a download that already opened the file keeps reading it
+        try:
+            os.remove(job.path)
+        except FileNotFoundError:
+            pass
+
+
+def parse_range(header, size):
+    # (start, end) of a single "bytes=" range, both inclusive, None when the
+    # whole file should be sent, ValueError when it can't be satisfied
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[6:].strip().partition('-')
+    if not (start or end) or not (start + end).isdigit():
+        return None
+    if start == '':
+        # suffix range, the last `end` bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+def read_file(f, start, end, chunk_size=64 * 1024):
+    # f is opened by the caller so an evicted file is noticed before the
+    # response starts
+    with f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
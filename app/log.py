@@ -0,0 +1,34 @@
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# share of the sampled debug messages that is actually logged
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+
+listener = None
+
+
+def setup_logging():
+    # records are handed to a queue and written by a background thread, so
+    # a slow stderr never blocks the event loop
+    global listener
+    logger = logging.getLogger('app')
+    logger.setLevel(LOG_LEVEL)
+    if listener is None:
+        records = queue.SimpleQueue()
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        listener = QueueListener(records, handler)
+        listener.start()
+        logger.addHandler(QueueHandler(records))
+        logger.propagate = False
+
+
+def debug_sampled(logger, msg, *args):
+    if logger.isEnabledFor(logging.DEBUG) and \
+            random.random() < LOG_SAMPLE_RATE:
+        logger.debug(msg, *args)
@@ -1,15 +1,44 @@
-import csv
+import asyncio
+import hmac
+import logging
 import os
-from elasticsearch import AsyncElasticsearch, AIOHttpConnection, ConnectionTimeout
-from fastapi import FastAPI, Response
-from fastapi.responses import StreamingResponse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import orjson
+from elasticsearch import ConnectionTimeout, NotFoundError, RequestError
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel
-import io
 
 from starlette.responses import JSONResponse
 
-from .constants import DATA_PORTAL_AGGREGATIONS, ARTICLES_AGGREGATIONS
+from .cache import PageCache, SingleFlight, TTLCache
+from .compression import CompressionMiddleware
+from .conditional import ETagMiddleware
+from .cursor import cursor_binding, decode_cursor, encode_cursor
+from .constants import NESTED_RECORDS, NESTED_RECORDS_FILTERS, \
+    NESTED_RECORDS_SORT_FIELDS, TAXONOMY_RANKS
+from .export import fetch_data_in_batches, fetch_data_in_slices, \
+    prepend_batch, create_data_files, export_source_fields, \
+    available_export_formats, EXPORT_FORMATS
+from .jobs import ExportJobs, parse_range, read_file
+from .query import parse_plan, compile_query, compile_aggregations, \
+    search_fields, with_search_ids, compile_details_aggregations, \
+    compile_records_query, with_ids_filter, parse_lineage, parse_sort, \
+    page_records
+from .log import setup_logging
+from .metrics import RATE_LIMITED, RequestTimer, register_cache
+from .search_index import NGRAM, NameIndex
+from .taxonomy import TaxonomyTree
+from .scheduler import RateLimiter, Rejected, Scheduler
+from .transport import CircuitOpenError, ResilientElasticsearch
+from .versions import IndexVersions
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -21,6 +50,144 @@ ES_HOST = os.getenv('ES_CONNECTION_URL')
 ES_USERNAME = os.getenv('ES_USERNAME')
 ES_PASSWORD = os.getenv('ES_PASSWORD')
 
+# ES transport: connection pool, per-profile timeouts, retries, hedging and
+# circuit breaker
+ES_POOL_SIZE = int(os.getenv('ES_POOL_SIZE', 10))
+ES_KEEPALIVE = float(os.getenv('ES_KEEPALIVE', 15))
+ES_LISTING_TIMEOUT = float(os.getenv('ES_LISTING_TIMEOUT', 10))
+ES_EXPORT_TIMEOUT = float(os.getenv('ES_EXPORT_TIMEOUT', 120))
+ES_MAX_RETRIES = int(os.getenv('ES_MAX_RETRIES', 2))
+ES_RETRY_BACKOFF = float(os.getenv('ES_RETRY_BACKOFF', 0.1))
+ES_HEDGE = os.getenv('ES_HEDGE', '1') == '1'
+ES_HEDGE_MIN_DELAY = float(os.getenv('ES_HEDGE_MIN_DELAY', 0.05))
+ES_BREAKER_THRESHOLD = int(os.getenv('ES_BREAKER_THRESHOLD', 5))
+ES_BREAKER_COOLDOWN = float(os.getenv('ES_BREAKER_COOLDOWN', 30))
+
+# ES calls running at once, interactive calls (listing, details) get freed
+# slots before bulk ones (exports, index builds)
+SCHEDULER_CAPACITY = int(os.getenv('SCHEDULER_CAPACITY', ES_POOL_SIZE))
+SCHEDULER_BULK_CONCURRENCY = int(os.getenv(
+    'SCHEDULER_BULK_CONCURRENCY', max(SCHEDULER_CAPACITY // 2, 1)))
+# waiting calls above which requests are shed with a 503
+SCHEDULER_INTERACTIVE_QUEUE = int(os.getenv('SCHEDULER_INTERACTIVE_QUEUE',
+                                            100))
+SCHEDULER_BULK_QUEUE = int(os.getenv('SCHEDULER_BULK_QUEUE', 50))
+SCHEDULER_RETRY_AFTER = int(os.getenv('SCHEDULER_RETRY_AFTER', 1))
+# export starts per minute and burst allowed for one client address, 0
+# turns the limit off. Behind a proxy TRUSTED_PROXIES has to be set as well,
+# otherwise every client shares the bucket of the proxy address
+EXPORT_RATE_LIMIT = float(os.getenv('EXPORT_RATE_LIMIT', 0))
+EXPORT_RATE_BURST = int(os.getenv('EXPORT_RATE_BURST', 5))
+# proxies in front of the service that append to X-Forwarded-For, the
+# client address is read that many entries from the right (0: not behind a
+# proxy, the header is ignored). TRUST_FORWARDED_FOR=1 means one proxy
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES',
+                                os.getenv('TRUST_FORWARDED_FOR', 0)))
+
+# export tuning, EXPORT_SLICES > 1 enables sliced parallel exports
+EXPORT_SLICES = int(os.getenv('EXPORT_SLICES', 1))
+EXPORT_SLICE_CONCURRENCY = int(os.getenv('EXPORT_SLICE_CONCURRENCY',
+                                         EXPORT_SLICES))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# number of workers converting hits into CSV rows, 0 keeps it on the loop
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 0))
+# 'thread' or 'process'
+EXPORT_WORKER_POOL = os.getenv('EXPORT_WORKER_POOL', 'thread')
+
+# background export jobs, their files are kept in the spool directory
+EXPORT_SPOOL_DIR = os.getenv('EXPORT_SPOOL_DIR', os.path.join(
+    tempfile.gettempdir(), 'portal-exports'))
+EXPORT_SPOOL_MAX_BYTES = int(os.getenv('EXPORT_SPOOL_MAX_BYTES',
+                                       2 * 1024 ** 3))
+EXPORT_SPOOL_MAX_AGE = int(os.getenv('EXPORT_SPOOL_MAX_AGE', 6 * 3600))
+EXPORT_JOBS_CONCURRENCY = int(os.getenv('EXPORT_JOBS_CONCURRENCY', 2))
+# an identical export finished less than this many seconds ago is reused
+EXPORT_JOBS_REUSE_AGE = int(os.getenv('EXPORT_JOBS_REUSE_AGE', 600))
+# queued export jobs above which new ones are refused
+EXPORT_JOBS_MAX_QUEUED = int(os.getenv('EXPORT_JOBS_MAX_QUEUED', 20))
+
+AGGREGATION_CACHE_SIZE = int(os.getenv('AGGREGATION_CACHE_SIZE', 512))
+AGGREGATION_CACHE_TTL = int(os.getenv('AGGREGATION_CACHE_TTL', 300))
+# shared secret of POST /cache/invalidate, sent in X-Invalidate-Token. The
+# endpoint is disabled without it, index version changes drop the caches
+CACHE_INVALIDATE_TOKEN = os.getenv('CACHE_INVALIDATE_TOKEN')
+
+# fetching the next listing page in the background after serving one
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '0') == '1'
+PREFETCH_TTL = int(os.getenv('PREFETCH_TTL', 30))
+PREFETCH_CACHE_SIZE = int(os.getenv('PREFETCH_CACHE_SIZE', 1024))
+PREFETCH_CACHE_BYTES = int(os.getenv('PREFETCH_CACHE_BYTES',
+                                     64 * 1024 * 1024))
+PREFETCH_MAX_IN_FLIGHT = int(os.getenv('PREFETCH_MAX_IN_FLIGHT', 8))
+
+# indices searched through the in-process name index instead of wildcards
+SEARCH_INDEX_NAMES = [name for name in os.getenv(
+    'SEARCH_INDEX_NAMES', 'data_portal').split(",") if name]
+SEARCH_INDEX_REFRESH = int(os.getenv('SEARCH_INDEX_REFRESH', 600))
+# above this many matching documents the wildcard query is used instead
+SEARCH_INDEX_MAX_IDS = int(os.getenv('SEARCH_INDEX_MAX_IDS', 10000))
+
+# indices whose phylogeny is served from an in-process taxonomy tree
+TAXONOMY_INDEX_NAMES = [name for name in os.getenv(
+    'TAXONOMY_INDEX_NAMES', 'data_portal').split(",") if name]
+TAXONOMY_REFRESH = int(os.getenv('TAXONOMY_REFRESH', 600))
+# phylogeny filters matching more documents stay nested queries
+TAXONOMY_MAX_IDS = int(os.getenv('TAXONOMY_MAX_IDS', 10000))
+
+# indices whose version is tracked, GET requests on them get ETags and their
+# caches are dropped as soon as the version changes
+INDEX_VERSION_NAMES = [name for name in os.getenv(
+    'INDEX_VERSION_NAMES', 'data_portal,tracking_status,articles,summary'
+).split(",") if name]
+INDEX_VERSION_REFRESH = int(os.getenv('INDEX_VERSION_REFRESH', 30))
+ETAG_CACHE_CONTROL = os.getenv('ETAG_CACHE_CONTROL', 'no-cache')
+# changing it invalidates every ETag, e.g. when a release changes responses
+ETAG_SALT = os.getenv('ETAG_SALT', '')
+# upper bound for a summary cached while its version can't be checked
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', 3600))
+
+BATCH_MAX_IDS = int(os.getenv('BATCH_MAX_IDS', 1000))
+# sub-queries of one /dashboard request
+DASHBOARD_MAX_QUERIES = int(os.getenv('DASHBOARD_MAX_QUERIES', 10))
+
+# index.max_inner_result_window of data_portal (ES default 100), deeper
+# record pages are cut from the record array of _source instead
+DETAILS_MAX_INNER_RESULTS = int(os.getenv('DETAILS_MAX_INNER_RESULTS', 100))
+
+# responses smaller than this are sent uncompressed
+COMPRESSION_MINIMUM_SIZE = int(os.getenv('COMPRESSION_MINIMUM_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', 4))
+
+# only the parts of the ES responses that are returned to the client
+LISTING_FILTER_PATH = 'took,hits.total.value,hits.hits,aggregations'
+CURSOR_FILTER_PATH = 'pit_id,' + LISTING_FILTER_PATH
+
+# listing pages from this offset on are read with search_after in a
+# point-in-time, pages before it keep using from/size
+CURSOR_OFFSET_LIMIT = int(os.getenv('CURSOR_OFFSET_LIMIT', 1000))
+CURSOR_KEEP_ALIVE = os.getenv('CURSOR_KEEP_ALIVE', '2m')
+# index.max_result_window, the deepest page from/size can read
+MAX_RESULT_WINDOW = int(os.getenv('MAX_RESULT_WINDOW', 10000))
+
+
+def etag_version(index):
+    # None while the name index or taxonomy tree of the index is older than
+    # the documents in ES, their answers would change once they are rebuilt
+    version = index_versions.get(index)
+    for built in (name_indexes.get(index), taxonomy_trees.get(index)):
+        if built is not None and built.version != version:
+            return None
+    return version
+
+
+# innermost, so 304 responses still get the CORS headers
+app.add_middleware(
+    ETagMiddleware,
+    index_version=etag_version,
+    cache_control=ETAG_CACHE_CONTROL,
+    salt=ETAG_SALT,
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -28,234 +195,549 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MINIMUM_SIZE,
+    gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY,
+)
 
-es = AsyncElasticsearch(
+scheduler = Scheduler(SCHEDULER_CAPACITY, SCHEDULER_RETRY_AFTER)
+scheduler.add_pool('interactive', 0, SCHEDULER_CAPACITY,
+                   SCHEDULER_INTERACTIVE_QUEUE)
+scheduler.add_pool('bulk', 1, SCHEDULER_BULK_CONCURRENCY,
+                   SCHEDULER_BULK_QUEUE)
+export_rate_limiter = None
+if EXPORT_RATE_LIMIT > 0:
+    export_rate_limiter = RateLimiter(EXPORT_RATE_LIMIT / 60,
+                                      EXPORT_RATE_BURST)
+
+es = ResilientElasticsearch(
     [ES_HOST],
-    timeout=60,
-    connection_class=AIOHttpConnection,
     http_auth=(ES_USERNAME, ES_PASSWORD),
-    use_ssl=True, verify_certs=False)
+    pool_size=ES_POOL_SIZE,
+    keepalive=ES_KEEPALIVE,
+    listing_timeout=ES_LISTING_TIMEOUT,
+    export_timeout=ES_EXPORT_TIMEOUT,
+    max_retries=ES_MAX_RETRIES,
+    backoff=ES_RETRY_BACKOFF,
+    hedge=ES_HEDGE,
+    hedge_min_delay=ES_HEDGE_MIN_DELAY,
+    breaker_threshold=ES_BREAKER_THRESHOLD,
+    breaker_cooldown=ES_BREAKER_COOLDOWN,
+    scheduler=scheduler)
+# long timeouts and no hedging for full index scans
+export_es = es.profile('export')
 
+export_executor = None
+export_jobs = ExportJobs(EXPORT_SPOOL_DIR, EXPORT_JOBS_CONCURRENCY,
+                         EXPORT_JOBS_REUSE_AGE, EXPORT_SPOOL_MAX_AGE,
+                         EXPORT_SPOOL_MAX_BYTES)
+# aggregations only depend on the query, not on the page that is shown
+aggregation_cache = TTLCache(AGGREGATION_CACHE_SIZE, AGGREGATION_CACHE_TTL)
+details_aggregation_cache = TTLCache(AGGREGATION_CACHE_SIZE,
+                                     AGGREGATION_CACHE_TTL)
+# identical listing searches running at the same time share one ES call
+search_flight = SingleFlight()
+# listing pages fetched ahead of the request
+page_cache = PageCache(PREFETCH_CACHE_SIZE, PREFETCH_TTL, PREFETCH_CACHE_BYTES)
+prefetch_tasks = set()
+# index name -> NameIndex, replaced as a whole on every refresh
+name_indexes = dict()
+name_index_task = None
+# index name -> TaxonomyTree, replaced as a whole on every refresh
+taxonomy_trees = dict()
+taxonomy_task = None
+# set when an index version changes, wakes the name index and taxonomy
+# tree rebuilds
+name_index_stale = asyncio.Event()
+taxonomy_stale = asyncio.Event()
+summary_cache = TTLCache(1, SUMMARY_CACHE_TTL)
 
-@app.get("/{index}")
-async def root(index: str, offset: int = 0, limit: int = 15,
-               sort: str | None = None, filter: str = None,
-               search: str = None, current_class: str = 'kingdom',
-               phylogeny_filters: str = None, action: str = None):
-    if index == 'favicon.ico':
-        return None
-    global value
 
-    # data structure for ES query
-    body = dict()
-    # building aggregations for every request
-    body["aggs"] = dict()
+def index_changed(index):
+    logger.info("Index %s changed, dropping its cached responses", index)
+    aggregation_cache.invalidate(index)
+    details_aggregation_cache.invalidate(index)
+    page_cache.invalidate(index)
+    summary_cache.invalidate(index)
+    name_index_stale.set()
+    taxonomy_stale.set()
 
-    if 'articles' in index:
-        aggregations_list = ARTICLES_AGGREGATIONS
-    else:
-        aggregations_list = DATA_PORTAL_AGGREGATIONS
 
-    for aggregation_field in aggregations_list:
-        if aggregation_field == 'images_available':
-            body["aggs"][aggregation_field] = {
-                "terms": {"field": aggregation_field}
-            }
-        else:
-            body["aggs"][aggregation_field] = {
-                "terms": {"field": aggregation_field + '.keyword'}
-            }
+index_versions = IndexVersions(INDEX_VERSION_NAMES, index_changed)
+index_version_task = None
 
-    if 'data_portal' in index:
-        body["aggs"]["experiment"] = {
-            "nested": {"path": "experiment"},
-            "aggs": {
-                "library_construction_protocol": {
-                    "terms": {
-                        "field": "experiment.library_construction_protocol.keyword",
-                    },
-                    "aggs": {
-                        "distinct_docs": {
-                            "reverse_nested": {},
-                            "aggs": {
-                                "parent_doc_count": {
-                                    "cardinality": {
-                                        "field": "organism.keyword"
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            }
-        }
+register_cache('aggregations', aggregation_cache)
+register_cache('details_aggregations', details_aggregation_cache)
+register_cache('search_single_flight', search_flight)
+register_cache('listing_pages', page_cache)
+register_cache('summary', summary_cache)
 
-        if 'data_portal' in index or 'tracking_status' in index:
-            body["aggs"]["genome_notes"] = {
-                "nested": {"path": "genome_notes"},
-                "aggs": {
-                    "genome_count": {
-                        "reverse_nested": {},  # get to the parent document level
-                        "aggs": {
-                            "distinct_docs": {
-                                "cardinality": {
-                                    "field": "organism.keyword"
-                                }
-                            }
-                        }
-                    }
-                }
-            }
 
-    body["aggs"]["taxonomies"] = {
-        "nested": {"path": f"taxonomies.{current_class}"},
-        "aggs": {current_class: {
-            "terms": {
-                "field": f"taxonomies.{current_class}.scientificName"
-            }
-        }
-        }
-    }
+@app.on_event("startup")
+async def start_es():
+    await es.start()
 
 
-    if phylogeny_filters:
-        body["query"] = {
-            "bool": {
-                "filter": list()
-            }
-        }
-        phylogeny_filters = phylogeny_filters.split("-")
-        print(phylogeny_filters)
-        for phylogeny_filter in phylogeny_filters:
-            name, value = phylogeny_filter.split(":")
-            nested_dict = {
-                "nested": {
-                    "path": f"taxonomies.{name}",
-                    "query": {
-                        "bool": {
-                            "filter": list()
-                        }
-                    }
-                }
-            }
-            nested_dict["nested"]["query"]["bool"]["filter"].append(
-                {
-                    "term": {
-                        f"taxonomies.{name}.scientificName": value
-                    }
-                }
-            )
-            body["query"]["bool"]["filter"].append(nested_dict)
-    # adding filters, format: filter_name1:filter_value1, etc...
-    if filter:
-        filters = filter.split(",")
-        if 'query' not in body:
-            body["query"] = {
-                "bool": {
-                    "filter": list()
-                }
-            }
-        for filter_item in filters:
-            if current_class in filter_item:
-                _, value = filter_item.split(":")
-
-                nested_dict = {
-                    "nested": {
-                        "path": f"taxonomies.{current_class}",
-                        "query": {
-                            "bool": {
-                                "filter": list()
-                            }
-                        }
-                    }
-                }
-                nested_dict["nested"]["query"]["bool"]["filter"].append(
-                    {
-                        "term": {
-                            f"taxonomies.{current_class}.scientificName": value
-                        }
-                    }
-                )
-                body["query"]["bool"]["filter"].append(nested_dict)
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(int(exc.retry_after) + 1)},
+        content={"error": "Elasticsearch is unavailable, try again later"})
 
-            else:
-                filter_name, filter_value = filter_item.split(":")
-
-                if filter_name == 'experimentType':
-
-                    nested_dict = {
-                        "nested": {
-                            "path": "experiment",
-                            "query": {
-                                "bool": {
-                                    "filter": {
-                                        "term": {
-                                            "experiment"
-                                            ".library_construction_protocol"
-                                            ".keyword": filter_value
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                elif filter_name == 'genome_notes':
-                    nested_dict = {
-                        'nested': {'path': 'genome_notes', 'query': {
-                            'bool': {
-                                'must': [
-                                    {'exists': {
-                                        'field': 'genome_notes.url'}}]}}}}
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                else:
-                    print(filter_name)
-                    body["query"]["bool"]["filter"].append(
-                        {"term": {filter_name: filter_value}})
-
-    # Adding search string
-    if search:
-        if "query" not in body:
-            body["query"] = {"bool": {"must": {"bool": {"should": []}}}}
+
+@app.exception_handler(Rejected)
+async def rejected_handler(request: Request, exc: Rejected):
+    return JSONResponse(
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)},
+        content={"error": exc.detail})
+
+
+@app.on_event("startup")
+async def start_export_executor():
+    global export_executor
+    if EXPORT_WORKERS > 0:
+        if EXPORT_WORKER_POOL == 'process':
+            export_executor = ProcessPoolExecutor(max_workers=EXPORT_WORKERS)
         else:
-            body["query"]["bool"].setdefault("must", {"bool": {"should": []}})
+            export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
 
-        search_fields = (
-            ["title", "journal_name", "study_id", "organism_name"]
-            if 'articles' in index
-            else ["organism", "commonName", "symbionts_records.organism.text", "metagenomes_records.organism.text"]
-        )
 
-        for field in search_fields:
-            body["query"]["bool"]["must"]["bool"]["should"].append({
-                "wildcard": {
-                    field: {
-                        "value": f"*{search}*",
-                        "case_insensitive": True
-                    }
-                }
-            })
+@app.on_event("shutdown")
+async def stop_export_executor():
+    if export_executor is not None:
+        export_executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("startup")
+async def start_export_jobs():
+    export_jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_export_jobs():
+    await export_jobs.close()
+
+
+async def wait_until_stale(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
 
-    if action == 'download':
+def is_current(built, version):
+    # rebuilt only when the documents changed, or always without a version
+    return built is not None and version is not None and \
+        built.version == version
+
+
+async def refresh_index_versions():
+    while True:
+        await asyncio.sleep(INDEX_VERSION_REFRESH)
         try:
-            response = await es.search(index=index, sort=sort, from_=offset,
-                                       body=body, size=limit)
-        except ConnectionTimeout:
-            return {"error": "Request to Elasticsearch timed out."}
+            await index_versions.refresh(es)
+        except Exception:
+            logger.exception("Refreshing index versions failed")
+
+
+@app.on_event("startup")
+async def start_index_versions():
+    global index_version_task
+    if INDEX_VERSION_NAMES:
+        # first versions before the name indexes and taxonomy trees are
+        # built, so they are built for a known version
+        try:
+            await index_versions.refresh(es)
+        except Exception:
+            logger.exception("Refreshing index versions failed")
+        index_version_task = asyncio.create_task(refresh_index_versions())
+
+
+@app.on_event("shutdown")
+async def stop_index_versions():
+    if index_version_task is not None:
+        index_version_task.cancel()
+
+
+async def refresh_name_indexes():
+    while True:
+        for index in SEARCH_INDEX_NAMES:
+            version = index_versions.get(index)
+            if is_current(name_indexes.get(index), version):
+                continue
+            try:
+                name_index = await NameIndex(
+                    index, search_fields(index)).build(export_es)
+                name_index.version = version
+                name_indexes[index] = name_index
+            except Exception:
+                # keep serving the previous index (or wildcards) until the
+                # next refresh
+                logger.exception("Building name index for %s failed", index)
+        await wait_until_stale(name_index_stale, SEARCH_INDEX_REFRESH)
+
+
+@app.on_event("startup")
+async def start_name_indexes():
+    global name_index_task
+    if SEARCH_INDEX_NAMES:
+        name_index_task = asyncio.create_task(refresh_name_indexes())
+
+
+@app.on_event("shutdown")
+async def stop_name_indexes():
+    if name_index_task is not None:
+        name_index_task.cancel()
+
+
+async def refresh_taxonomy_trees():
+    while True:
+        for index in TAXONOMY_INDEX_NAMES:
+            version = index_versions.get(index)
+            if is_current(taxonomy_trees.get(index), version):
+                continue
+            try:
+                tree = await TaxonomyTree(
+                    index, TAXONOMY_RANKS).build(export_es)
+                tree.version = version
+                taxonomy_trees[index] = tree
+            except Exception:
+                # phylogeny filters stay nested queries until the next
+                # refresh
+                logger.exception("Building taxonomy tree for %s failed",
+                                  index)
+        await wait_until_stale(taxonomy_stale, TAXONOMY_REFRESH)
+
+
+@app.on_event("startup")
+async def start_taxonomy_trees():
+    global taxonomy_task
+    if TAXONOMY_INDEX_NAMES:
+        taxonomy_task = asyncio.create_task(refresh_taxonomy_trees())
+
+
+@app.on_event("shutdown")
+async def stop_taxonomy_trees():
+    if taxonomy_task is not None:
+        taxonomy_task.cancel()
+
+
+# after everything that still talks to ES
+@app.on_event("shutdown")
+async def stop_es():
+    await es.close()
+
+
+def resolve_query(plan):
+    tree = taxonomy_trees.get(plan.index)
+    if plan.phylogeny_filters and tree is not None and \
+            tree.resolves(plan.phylogeny_filters) and \
+            tree.count(plan.phylogeny_filters) <= TAXONOMY_MAX_IDS:
+        # the nested taxonomy queries become one ids filter
+        query = with_ids_filter(
+            compile_query(plan._replace(phylogeny_filters=())),
+            tree.resolve(plan.phylogeny_filters))
     else:
-        response = await es.search(index=index, sort=sort, from_=offset, size=limit, body=body)
+        query = compile_query(plan)
+    name_index = name_indexes.get(plan.index)
+    # searches shorter than a gram would scan every name and match most
+    # documents, the wildcard query handles them
+    if plan.search and len(plan.search) >= NGRAM and name_index is not None:
+        ids = name_index.lookup(plan.search)
+        if len(ids) <= SEARCH_INDEX_MAX_IDS:
+            query = with_search_ids(query, ids)
+    return query
+
 
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def listing_body(plan, fields=None):
+    # ES body of a listing page without paging and sort, aggregations are
+    # only asked for when they are not cached for this query
+    body = dict()
+    cache_key = (plan.index, plan.key)
+    aggregations = aggregation_cache.get(cache_key)
+    if aggregations is None:
+        body["aggs"] = compile_aggregations(plan.index, plan.current_class)
+    query = resolve_query(plan)
+    if query:
+        body["query"] = query
+    # optional comma separated list of _source fields the page shows
+    if fields:
+        body["_source"] = fields.split(",")
+    return body, cache_key, aggregations
+
+
+def listing_data(response, cache_key, aggregations):
     data = dict()
     data['count'] = response['hits']['total']['value']
     data['results'] = response['hits']['hits']
-    data['aggregations'] = response['aggregations']
+    if aggregations is None:
+        aggregations = response['aggregations']
+        aggregation_cache.set(cache_key, aggregations)
+    data['aggregations'] = aggregations
     return data
 
 
+async def search_after_page(index, body, sort, limit, cursor):
+    # listing page read with search_after inside a point-in-time, the
+    # first page of a point-in-time is read by offset
+    # same order as the offset pages, which are sorted by score without a
+    # sort, _shard_doc only breaks ties
+    body = dict(body, size=limit,
+                sort=(parse_sort(sort) or [{"_score": "desc"}]) +
+                [{"_shard_doc": "asc"}])
+    if "p" in cursor:
+        try:
+            return await es.search(
+                body=dict(body, search_after=cursor["a"],
+                          pit={"id": cursor["p"],
+                               "keep_alive": CURSOR_KEEP_ALIVE}),
+                filter_path=CURSOR_FILTER_PATH)
+        except NotFoundError:
+            # point-in-time expired, the page is looked up by offset in a
+            # new one when it is still in reach of from/size
+            pass
+    if cursor["o"] + limit > MAX_RESULT_WINDOW:
+        raise HTTPException(status_code=410,
+                            detail="Cursor expired, start from the first "
+                                   "page again")
+    pit = await es.open_point_in_time(index=index,
+                                      keep_alive=CURSOR_KEEP_ALIVE)
+    body["from"] = cursor["o"]
+    return await es.search(
+        body=dict(body, pit={"id": pit["id"],
+                             "keep_alive": CURSOR_KEEP_ALIVE}),
+        filter_path=CURSOR_FILTER_PATH)
+
+
+def prefetch_page(search_key, body, offset):
+    # fetches the listing page at offset in the background, shared with
+    # the request for it when that arrives while the fetch is in flight
+    index, plan_key, _, limit, sort, fields, _ = search_key
+    search_key = (index, plan_key, offset, limit, sort, fields, False)
+    page_key = search_key[:-1]
+    if page_key in page_cache or offset + limit > MAX_RESULT_WINDOW or \
+            len(prefetch_tasks) >= PREFETCH_MAX_IN_FLIGHT or \
+            scheduler.pools['interactive'].queue:
+        return
+    body = {key: value for key, value in body.items() if key != "aggs"}
+
+    def run_search():
+        return es.search(index=index, sort=sort, from_=offset, size=limit,
+                         body=body, filter_path=LISTING_FILTER_PATH)
+
+    async def prefetch():
+        try:
+            response = await search_flight.do(search_key, run_search)
+        except Exception:
+            # only speculative, the request for the page will try again
+            logger.debug("Prefetching %s failed", page_key, exc_info=True)
+            return
+        page_cache.set(page_key, response,
+                       len(orjson.dumps(response['hits']['hits'])))
+
+    task = asyncio.create_task(prefetch())
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+
+
+# before GET /{index}, which would take the path otherwise
+@app.get("/summary")
+async def summary():
+    timer = RequestTimer('summary')
+    # only changes on ingestion runs, dropped when its version changes
+    data = summary_cache.get(('summary',))
+    if data is None:
+        response = await es.search(index="summary",
+                                   filter_path='took,hits.hits')
+        timer.es(response)
+        data = dict()
+        data['results'] = response['hits']['hits']
+        summary_cache.set(('summary',), data)
+    response = ORJSONResponse(data)
+    timer.phase('serialization')
+    timer.done()
+    return response
+
+
+@app.get("/{index}")
+async def root(index: str, offset: int = 0, limit: int = 15,
+               sort: str | None = None, filter: str = None,
+               search: str = None, current_class: str = 'kingdom',
+               phylogeny_filters: str = None, action: str = None,
+               fields: str = None, cursor: str = None):
+    if index == 'favicon.ico':
+        return None
+
+    timer = RequestTimer('root')
+    plan = parse_plan(index, filter, search, current_class,
+                      phylogeny_filters)
+    binding = cursor_binding(plan, sort)
+    # the cursor of the previous page replaces offset, small offsets are
+    # still read with from/size
+    if cursor is not None:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Malformed cursor")
+        if cursor["k"] != binding:
+            raise HTTPException(status_code=400,
+                                detail="Cursor doesn't match the query")
+        offset = cursor["o"]
+        if "p" not in cursor and offset < CURSOR_OFFSET_LIMIT:
+            cursor = None
+
+    body, cache_key, aggregations = listing_body(plan, fields)
+    search_key = (index, plan.key, offset, limit, sort, fields,
+                  "aggs" in body)
+    timer.phase('query_build')
+
+    def run_search():
+        return es.search(index=index, sort=sort, from_=offset, size=limit,
+                         body=body, filter_path=LISTING_FILTER_PATH)
+
+    page_key = search_key[:-1]
+    page = None
+    # prefetched pages carry no aggregations, they are only used while the
+    # aggregations are cached too
+    if PREFETCH_ENABLED and cursor is None and aggregations is not None:
+        page = page_cache.get(page_key)
+
+    if page is not None:
+        response = page
+    elif cursor is not None:
+        response = await search_after_page(index, body, sort, limit, cursor)
+    elif action == 'download':
+        try:
+            response = await search_flight.do(search_key, run_search)
+        except ConnectionTimeout:
+            return {"error": "Request to Elasticsearch timed out."}
+    else:
+        response = await search_flight.do(search_key, run_search)
+    timer.es(response)
+
+    data = listing_data(response, cache_key, aggregations)
+    data['next'] = None
+    if cursor is None:
+        if len(data['results']) == limit and \
+                offset + limit < data['count']:
+            data['next'] = encode_cursor(binding, offset + limit)
+            if PREFETCH_ENABLED:
+                prefetch_page(search_key, body, offset + limit)
+    elif len(data['results']) == limit:
+        # the sort values of the last hit, tiebreaker included, are where
+        # the next page starts
+        data['next'] = encode_cursor(binding, offset + limit,
+                                     response['pit_id'],
+                                     data['results'][-1]['sort'])
+    else:
+        # last page, nobody needs the point-in-time any more
+        try:
+            await es.close_point_in_time(body={"id": response['pit_id']})
+        except NotFoundError:
+            pass
+    # returned as a response so FastAPI doesn't run the ES hits through
+    # jsonable_encoder
+    response = ORJSONResponse(data)
+    timer.phase('serialization')
+    timer.done()
+    return response
+
+
+@app.get("/{index}/suggest")
+async def suggest(index: str, q: str, limit: int = 10):
+    if index not in SEARCH_INDEX_NAMES:
+        raise HTTPException(status_code=404,
+                            detail="No search index for this index")
+    name_index = name_indexes.get(index)
+    if name_index is None:
+        # only until the first build is done
+        raise HTTPException(status_code=503,
+                            detail="Search index is not ready")
+    return {"results": name_index.suggest(q, limit)}
+
+
+@app.get("/{index}/tree")
+async def taxonomy_tree(index: str, path: str = None):
+    # children of the node at the end of path, given in the format of
+    # phylogeny_filters, without path the top of the tree
+    if index not in TAXONOMY_INDEX_NAMES:
+        raise HTTPException(status_code=404,
+                            detail="No taxonomy tree for this index")
+    tree = taxonomy_trees.get(index)
+    if tree is None:
+        # only until the first build is done
+        raise HTTPException(status_code=503,
+                            detail="Taxonomy tree is not ready")
+    try:
+        node = tree.find(parse_lineage(path))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed path")
+    if node is None:
+        raise HTTPException(status_code=404, detail="Unknown taxon")
+    data = node.to_dict()
+    data['children'] = tree.children(node)
+    return ORJSONResponse(data)
+
+
 @app.get("/{index}/{record_id}")
-async def details(index: str, record_id: str):
+async def details(index: str, record_id: str, source: str = None,
+                  records: str = None, offset: int = 0, limit: int = 15,
+                  sort: str = None, filter: str = None):
+    timer = RequestTimer('details')
+    # optional comma separated list of _source fields to return
+    source_includes = source.split(",") if source else None
     body = dict()
+    if source_includes:
+        body["_source"] = source_includes
     if 'data_portal' in index:
+        if records is not None and records not in NESTED_RECORDS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"records must be one of {', '.join(NESTED_RECORDS)}")
+        if offset < 0 or limit < 0:
+            raise HTTPException(status_code=400,
+                                detail="offset and limit must be positive")
+        if records and filter and any(
+                filter_item.partition(":")[0] not in NESTED_RECORDS_FILTERS
+                or not filter_item.partition(":")[1]
+                for filter_item in filter.split(",")):
+            raise HTTPException(
+                status_code=400,
+                detail=f"records are filtered as name:value, with a name "
+                       f"of {', '.join(NESTED_RECORDS_FILTERS)}")
+        if records and any(
+                field not in NESTED_RECORDS_SORT_FIELDS or
+                order['order'] not in ('asc', 'desc')
+                for sort_item in parse_sort(sort)
+                for field, order in sort_item.items()):
+            raise HTTPException(
+                status_code=400,
+                detail=f"records can be sorted on "
+                       f"{', '.join(NESTED_RECORDS_SORT_FIELDS)}, "
+                       f"asc or desc")
+        # inner_hits can't page beyond index.max_inner_result_window
+        paged_by_es = records and offset + limit <= DETAILS_MAX_INNER_RESULTS
+
+        # the record arrays are only returned page by page through
+        # inner_hits, unless they are asked for explicitly in source
+        body["_source"] = {"excludes": [
+            path for path in NESTED_RECORDS
+            if (not source_includes or path not in source_includes) and
+            (paged_by_es or path != records)]}
+        if source_includes:
+            body["_source"]["includes"] = source_includes
+            if records and not paged_by_es:
+                body["_source"]["includes"] = source_includes + [records]
         body["query"] = {
             "bool": {
                 "filter": [
@@ -267,86 +749,217 @@ async def details(index: str, record_id: str):
                 ]
             }
         }
-        body["aggs"] = dict()
-        body["aggs"]["metadata_filters"] = {
-            'nested': {'path': 'records'},
-            "aggs": {
-                'sex_filter': {
-                    'terms': {
-                        'field':
-                            'records.sex.keyword',
-                        'size': 2000}},
-                'tracking_status_filter': {
-                    'terms': {
-                        'field':
-                            'records.'
-                            'trackingSystem.keyword',
-                        'size': 2000}},
-                'organism_part_filter': {
-                    'terms': {
-                        'field': 'records'
-                                 '.organismPart.keyword',
-                        'size': 2000}}
-            }}
-        body["aggs"]["symbionts_filters"] = {
-            'nested': {'path': 'symbionts_records'},
-            "aggs": {
-                'sex_filter': {
-                    'terms': {
-                        'field':
-                            'symbionts_records.sex.keyword',
-                        'size': 2000}},
-                'tracking_status_filter': {
-                    'terms': {
-                        'field':
-                            'symbionts_records.'
-                            'trackingSystem.keyword',
-                        'size': 2000}},
-                'organism_part_filter': {
-                    'terms': {
-                        'field': 'symbionts_records'
-                                 '.organismPart.keyword',
-                        'size': 2000}}
-            }}
-        body['aggs']['metagenomes_filters'] = {
-            'nested': {'path': 'metagenomes_records'},
-            "aggs": {
-                'sex_filter': {
-                    'terms': {
-                        'field':
-                            'metagenomes_records.sex.keyword',
-                        'size': 2000}},
-                'tracking_status_filter': {
-                    'terms': {
-                        'field':
-                            'metagenomes_records.'
-                            'trackingSystem.keyword',
-                        'size': 2000}},
-                'organism_part_filter': {
-                    'terms': {
-                        'field': 'metagenomes_records'
-                                 '.organismPart.keyword',
-                        'size': 2000}}
-            }}
-
-        response = await es.search(index=index, body=body)
-        aggregations = response['aggregations']
-    else:
-        response = await es.search(index=index, q=f"_id:{record_id}")
+        if paged_by_es:
+            # in should, so the organism is returned even without a
+            # matching record
+            body["query"]["bool"]["should"] = [compile_records_query(
+                records, filter, sort, offset, limit)]
+
+        # facets of an organism don't change between reloads
+        cache_key = (index, record_id)
+        aggregations = details_aggregation_cache.get(cache_key)
+        if aggregations is None:
+            body["aggs"] = compile_details_aggregations()
+        timer.phase('query_build')
+
+        try:
+            response = await es.search(index=index, body=body,
+                                       filter_path=LISTING_FILTER_PATH)
+        except RequestError as e:
+            if not paged_by_es:
+                raise
+            # e.g. a sort on a field the records of this index don't map
+            raise HTTPException(status_code=400,
+                                detail=f"Invalid records query: {e.error}")
+        timer.es(response)
+        data = dict()
+        data['count'] = response['hits']['total']['value']
+        data['results'] = response['hits']['hits']
+        if paged_by_es:
+            inner_hits = [hit.pop('inner_hits', {}).get(records)
+                          for hit in data['results']]
+            inner_hits = [hits['hits'] for hits in inner_hits if hits]
+            data['records'] = {
+                'count': sum(hits['total']['value'] for hits in inner_hits),
+                'results': [inner_hit['_source'] for hits in inner_hits
+                            for inner_hit in hits['hits']]
+            }
+        elif records:
+            keep = source_includes and records in source_includes
+            record_list = list()
+            for hit in data['results']:
+                source = hit.get('_source', {})
+                if keep:
+                    record_list.extend(source.get(records) or [])
+                else:
+                    record_list.extend(source.pop(records, None) or [])
+            count, page = page_records(record_list, filter, sort, offset,
+                                       limit)
+            data['records'] = {'count': count, 'results': page}
+        if aggregations is None:
+            aggregations = response['aggregations']
+            details_aggregation_cache.set(cache_key, aggregations)
+        data['aggregations'] = aggregations
+        response = ORJSONResponse(data)
+        timer.phase('serialization')
+        timer.done()
+        return response
+
+    # other indices are looked up by _id, a realtime get is much cheaper
+    # than a query_string search
+    timer.phase('query_build')
+    try:
+        document = await es.get(index=index, id=record_id,
+                                _source_includes=source_includes)
+        results = [document] if document.get('found') else []
+    except NotFoundError:
+        document = dict()
+        results = []
+    timer.es(document)
     data = dict()
-    data['count'] = response['hits']['total']['value']
-    data['results'] = response['hits']['hits']
+    data['count'] = len(results)
+    data['results'] = results
+    response = ORJSONResponse(data)
+    timer.phase('serialization')
+    timer.done()
+    return response
+
+
+class BatchParam(BaseModel):
+    # record ids, or organisms for data_portal
+    ids: list[str]
+    # optional _source includes, all fields by default
+    source: list[str] | None = None
+
+
+@app.post("/{index}/batch")
+async def batch_details(index: str, item: BatchParam):
+    if len(item.ids) > BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {BATCH_MAX_IDS} ids can be requested at once")
+    if not item.ids:
+        return {'count': 0, 'results': [], 'missing': []}
+
+    timer = RequestTimer('batch')
     if 'data_portal' in index:
-        data['aggregations'] = aggregations
-    return data
+        body = {
+            "query": {"bool": {"filter": [{"terms": {"organism": item.ids}}]}}
+        }
+        if item.source:
+            # organism is needed to match the hits to the requested ids
+            body["_source"] = list(set(item.source) | {'organism'})
+        timer.phase('query_build')
+        response = await es.search(index=index, body=body,
+                                   size=len(item.ids))
+        timer.es(response)
+        found = {hit['_source'].get('organism', hit['_id']): hit
+                 for hit in response['hits']['hits']}
+    else:
+        timer.phase('query_build')
+        response = await es.mget(index=index, body={"ids": item.ids},
+                                 _source_includes=item.source)
+        timer.es(response)
+        found = {document['_id']: document
+                 for document in response['docs'] if document.get('found')}
+
+    # results keep the order of the requested ids
+    data = dict()
+    data['results'] = [found[record_id] for record_id in item.ids
+                       if record_id in found]
+    data['count'] = len(data['results'])
+    data['missing'] = [record_id for record_id in item.ids
+                       if record_id not in found]
+    response = ORJSONResponse(data)
+    timer.phase('serialization')
+    timer.done()
+    return response
 
 
-@app.get("/summary")
-async def summary():
-    response = await es.search(index="summary")
+class DashboardQuery(BaseModel):
+    # key of the result, the parameters of GET /{index} otherwise, with
+    # index "summary" for the summary
+    name: str
+    index: str
+    offset: int = 0
+    limit: int = 15
+    sort: str | None = None
+    filter: str | None = None
+    search: str | None = None
+    current_class: str = 'kingdom'
+    phylogeny_filters: str | None = None
+    fields: str | None = None
+
+
+class DashboardParam(BaseModel):
+    queries: list[DashboardQuery]
+
+
+@app.post("/dashboard")
+async def dashboard(item: DashboardParam):
+    # all sub-queries in one _msearch round trip
+    if len(item.queries) > DASHBOARD_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {DASHBOARD_MAX_QUERIES} queries can be sent "
+                   f"at once")
+    if len({query.name for query in item.queries}) < len(item.queries):
+        raise HTTPException(status_code=400,
+                            detail="Query names must be unique")
+    timer = RequestTimer('dashboard')
+    searches = list()
+    listings = list()
+    for query in item.queries:
+        if query.index == 'summary':
+            body = dict()
+            listings.append(None)
+        else:
+            plan = parse_plan(query.index, query.filter, query.search,
+                              query.current_class, query.phylogeny_filters)
+            body, cache_key, aggregations = listing_body(plan, query.fields)
+            body = dict(body, size=query.limit, sort=parse_sort(query.sort))
+            body["from"] = query.offset
+            listings.append((cache_key, aggregations))
+        searches.append({"index": query.index})
+        searches.append(body)
+    timer.phase('query_build')
+
     data = dict()
-    data['results'] = response['hits']['hits']
-    return data
+    if searches:
+        response = await es.msearch(
+            body=searches,
+            filter_path='took,responses.status,responses.error,'
+                        'responses.hits.total.value,responses.hits.hits,'
+                        'responses.aggregations')
+        for query, listing, result in zip(item.queries, listings,
+                                          response['responses']):
+            if 'error' in result:
+                data[query.name] = {'error': result['error'],
+                                    'status': result.get('status')}
+            elif listing is None:
+                data[query.name] = {'results': result['hits']['hits']}
+            else:
+                data[query.name] = listing_data(result, *listing)
+        timer.es(response)
+    response = ORJSONResponse(data)
+    timer.phase('serialization')
+    timer.done()
+    return response
+
+
+@app.post("/cache/invalidate")
+async def invalidate_cache(request: Request, index: str = None):
+    # called after an index is reloaded, without index all entries are dropped
+    if not CACHE_INVALIDATE_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(
+            request.headers.get('x-invalidate-token', '').encode(),
+            CACHE_INVALIDATE_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid token")
+    removed = aggregation_cache.invalidate(index) + \
+        details_aggregation_cache.invalidate(index) + \
+        page_cache.invalidate(index) + summary_cache.invalidate(index)
+    return {"invalidated": removed}
 
 
 class QueryParam(BaseModel):
@@ -359,19 +972,84 @@ class QueryParam(BaseModel):
     phylogeny_filters: str
     index_name: str
     downloadOption: str
+    format: str = 'csv'
+
+
+def check_export_format(item):
+    # media type and file extension of the requested format
+    if item.format not in available_export_formats():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported format {item.format}, use one of "
+                   f"{', '.join(available_export_formats())}")
+    return EXPORT_FORMATS[item.format]
+
+
+def export_batches(item, query):
+    # only the fields the CSV of this download option is built from
+    source = export_source_fields(item.downloadOption, item.index_name)
+    if EXPORT_SLICES > 1:
+        return fetch_data_in_slices(
+            export_es, item.index_name, query, item.sortValue,
+            slices=EXPORT_SLICES, concurrency=EXPORT_SLICE_CONCURRENCY,
+            batch_size=EXPORT_BATCH_SIZE, source=source)
+    return fetch_data_in_batches(export_es, item.index_name, query,
+                                 item.sortValue,
+                                 batch_size=EXPORT_BATCH_SIZE, source=source)
+
+
+def client_address(request):
+    if TRUSTED_PROXIES > 0 and "x-forwarded-for" in request.headers:
+        # entries on the left are set by the client, only those appended by
+        # our own proxies can be trusted
+        forwarded = [address.strip() for address in
+                     request.headers["x-forwarded-for"].split(",")]
+        return forwarded[max(len(forwarded) - TRUSTED_PROXIES, 0)]
+    return request.client.host if request.client else None
+
+
+def limit_export_rate(request, endpoint):
+    if export_rate_limiter is None:
+        return
+    retry_after = export_rate_limiter.check(client_address(request))
+    if retry_after:
+        RATE_LIMITED.labels(endpoint).inc()
+        raise Rejected(429, retry_after,
+                       "Too many exports started, try again later")
 
 
 @app.post("/data-download")
-async def get_data_files(item: QueryParam):
-    data = await fetch_data_in_batches(item)
-    if len(data) > 0:
-        csv_data = create_data_files_csv(data, item.downloadOption,
-                                         item.index_name)
+async def get_data_files(item: QueryParam, request: Request):
+    timer = RequestTimer('data-download')
+    media_type, extension = check_export_format(item)
+    limit_export_rate(request, 'data-download')
+    # a running export is never shed, so new ones are refused up front
+    scheduler.admit('bulk')
+    query = resolve_query(parse_plan(
+        item.index_name, item.filterValue, item.searchValue,
+        item.currentClass, item.phylogeny_filters))
+    batches = export_batches(item, query)
+    timer.phase('query_build')
+    # peek at the first batch so an empty or failed export still gets a
+    # proper error response instead of an empty attachment
+    try:
+        first_batch = await batches.__anext__()
+    except (StopAsyncIteration, ConnectionTimeout):
+        first_batch = None
+    # time to the first batch, the rows are tracked by the export counters
+    timer.done()
+
+    if first_batch:
+        data = create_data_files(
+            prepend_batch(first_batch, batches), item.downloadOption,
+            item.index_name, item.format, executor=export_executor,
+            max_pending=max(EXPORT_WORKERS, 1) * 2)
 
         return StreamingResponse(
-            csv_data,
-            media_type='text/csv',
-            headers={"Content-Disposition": "attachment; filename=download.csv"}
+            data,
+            media_type=media_type,
+            headers={"Content-Disposition":
+                     f"attachment; filename=download{extension}"}
         )
     else:
         return JSONResponse(
@@ -380,134 +1058,78 @@ async def get_data_files(item: QueryParam):
         )
 
 
-async def fetch_data_in_batches(item: QueryParam):
-    offset = 0
-    batch_size = 1000
-    all_data = []
+@app.post("/data-download/jobs")
+async def create_export_job(item: QueryParam, request: Request):
+    media_type, extension = check_export_format(item)
+    limit_export_rate(request, 'data-download-jobs')
+    if export_jobs.queued() >= EXPORT_JOBS_MAX_QUEUED:
+        raise Rejected(503, SCHEDULER_RETRY_AFTER,
+                       "Too many exports queued, try again later")
+    plan = parse_plan(item.index_name, item.filterValue, item.searchValue,
+                      item.currentClass, item.phylogeny_filters)
+    # paging doesn't change an export, everything else does
+    key = (plan.key, item.sortValue, item.downloadOption.lower(), item.format)
 
-    while True:
+    async def run(job):
+        query = resolve_query(plan)
+        count = await export_es.count(
+            index=item.index_name,
+            body={"query": query} if query is not None else None)
+        job.total = count['count']
 
-        data = await root(
-            item.index_name, offset, batch_size,
-            item.sortValue, item.filterValue,
-            item.searchValue, item.currentClass,
-            item.phylogeny_filters, 'download'
-        )
+        async def counted(batches):
+            async for batch in batches:
+                job.documents += len(batch)
+                yield batch
 
+        async for chunk in create_data_files(
+                counted(export_batches(item, query)), item.downloadOption,
+                item.index_name, item.format, executor=export_executor,
+                max_pending=max(EXPORT_WORKERS, 1) * 2):
+            yield chunk
 
-        results = data.get('results', [])
-        if not results:
-            break
-
-        all_data.extend(results)
-        offset += batch_size
-        print(f"Fetched {len(results)} results, total: {len(all_data)}")
-
-    return all_data
-
-
-def create_data_files_csv(results, download_option, index_name):
-    INSDC_ID = ''
-    tolid_str = ''
-    header = []
-    if download_option.lower() == "assemblies":
-        header = ["Scientific Name", "Accession", "Version", "Assembly Name", "Assembly Description",
-                  "Link to chromosomes, contigs and scaffolds all in one"]
-    elif download_option.lower() == "annotation":
-        header = ["Annotation GTF", "Annotation GFF3", "Proteins Fasta", "Transcripts Fasta",
-                  "Softmasked genomes Fasta"]
-    elif download_option.lower() == "raw_files":
-        header = ["Study Accession", "Sample Accession", "Experiment Accession", "Run Accession", "Tax Id",
-                  "Scientific Name", "FASTQ FTP", "Submitted FTP", "SRA FTP", "Library Construction Protocol"]
-    elif download_option.lower() == "metadata" and 'data_portal' in index_name:
-        header = ['Organism', 'Common Name', 'Common Name Source', 'Current Status','INSDC ID', 'ToL ID']
-    elif download_option.lower() == "metadata" and 'tracking_status' in index_name:
-        header = ['Organism', 'Common Name', 'Metadata submitted to BioSamples', 'Raw data submitted to ENA',
-                  'Mapped reads submitted to ENA', 'Assemblies submitted to ENA',
-                  'Annotation complete', 'Annotation submitted to ENA']
-
-    output = io.StringIO()
-    csv_writer = csv.writer(output)
-    csv_writer.writerow(header)
-
-    for entry in results:
-        record = entry["_source"]
-        if download_option.lower() == "assemblies":
-            assemblies = record.get("assemblies", [])
-            scientific_name = record.get("organism", "")
-            for assembly in assemblies:
-                accession = assembly.get("accession", "-")
-                version = assembly.get("version", "-")
-                assembly_name = assembly.get("assembly_name", "")
-                assembly_description = assembly.get("description", "")
-                link = f"https://www.ebi.ac.uk/ena/browser/api/fasta/{accession}?download=true&gzip=true" if accession else ""
-                entry = [scientific_name, accession, version, assembly_name, assembly_description, link]
-                csv_writer.writerow(entry)
-
-        elif download_option.lower() == "annotation":
-            annotations = record.get("annotation", [])
-            print("annotations: ", annotations)
-            for annotation in annotations:
-                gtf = annotation.get("annotation", {}).get("GTF", "-")
-                gff3 = annotation.get("annotation", {}).get("GFF3", "-")
-                proteins_fasta = annotation.get("proteins", {}).get("FASTA", "")
-                transcripts_fasta = annotation.get("transcripts", {}).get("FASTA", "")
-                softmasked_genomes_fasta = annotation.get("softmasked_genome", {}).get("FASTA", "")
-                entry = [gtf, gff3, proteins_fasta, transcripts_fasta, softmasked_genomes_fasta]
-                csv_writer.writerow(entry)
-
-        elif download_option.lower() == "raw_files":
-            experiments = record.get("experiment", [])
-            for experiment in experiments:
-                study_accession = experiment.get("study_accession", "")
-                sample_accession = experiment.get("sample_accession", "")
-                experiment_accession = experiment.get("experiment_accession", "")
-                run_accession = experiment.get("run_accession", "")
-                tax_id = experiment.get("tax_id", "")
-                scientific_name = experiment.get("scientific_name", "")
-                submitted_ftp = experiment.get("submitted_ftp", "")
-                sra_ftp = experiment.get("sra-ftp", "")
-                library_construction_protocol = experiment.get("library_construction_protocol", "")
-                fastq_ftp = experiment.get("fastq_ftp", "")
-
-                if fastq_ftp:
-                    fastq_list = fastq_ftp.split(";")
-                    for fastq in fastq_list:
-                        entry = [study_accession, sample_accession, experiment_accession, run_accession, tax_id,
-                                 scientific_name, fastq, submitted_ftp, sra_ftp, library_construction_protocol]
-                        csv_writer.writerow(entry)
-                else:
-                    entry = [study_accession, sample_accession, experiment_accession, run_accession, tax_id,
-                             scientific_name, fastq_ftp, submitted_ftp, sra_ftp, library_construction_protocol]
-                    csv_writer.writerow(entry)
-
-        elif download_option.lower() == "metadata" and 'data_portal' in index_name:
-            organism = record.get('organism', '')
-            common_name = record.get('commonName', '')
-            common_name_source = record.get('commonNameSource', '')
-            current_status = record.get('currentStatus', '')
-            tolids = record.get('tolid', [])
-            print(tolids)
-            if tolids:
-                tolid_str = ", ".join(map(str, tolids))
-            experiments = record.get("experiment", [])
-            if experiments:
-                INSDC_ID = experiments[0].get("study_accession", "")
-            entry = [organism, common_name, common_name_source, current_status, INSDC_ID, tolid_str]
-            csv_writer.writerow(entry)
-
-        elif download_option.lower() == "metadata" and 'tracking_status' in index_name:
-            organism = record.get('organism', '')
-            common_name = record.get('commonName', '')
-            metadata_biosamples = record.get('biosamples', '')
-            raw_data_ena = record.get('raw_data', '')
-            mapped_reads_ena = record.get('mapped_reads', '')
-            assemblies_ena = record.get('assemblies_status', '')
-            annotation_complete = record.get('annotation_complete', '')
-            annotation_submitted_ena = record.get('annotation_status', '')
-            entry = [organism, common_name, metadata_biosamples, raw_data_ena, mapped_reads_ena, assemblies_ena,
-                     annotation_complete, annotation_submitted_ena]
-            csv_writer.writerow(entry)
-
-    output.seek(0)
-    return io.BytesIO(output.getvalue().encode('utf-8'))
+    job, created = export_jobs.submit(key, run, extension, media_type)
+    return ORJSONResponse(job.to_dict(), status_code=202 if created else 200)
+
+
+@app.get("/data-download/jobs/{job_id}")
+async def export_job_status(job_id: str):
+    job = export_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown export job")
+    return ORJSONResponse(job.to_dict())
+
+
+@app.get("/data-download/jobs/{job_id}/file")
+async def export_job_file(job_id: str, request: Request):
+    job = export_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown export job")
+    if job.status != 'done':
+        return JSONResponse(status_code=409, content=job.to_dict())
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{job.id}"',
+        "Content-Disposition":
+            f"attachment; filename=download{job.extension}",
+    }
+    byte_range = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range != headers["ETag"]:
+        byte_range = None
+    try:
+        byte_range = parse_range(byte_range, job.size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{job.size}"
+        return Response(status_code=416, headers=headers)
+    try:
+        f = open(job.path, 'rb')
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Unknown export job")
+    start, end = byte_range or (0, job.size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{job.size}"
+    return StreamingResponse(read_file(f, start, end),
+                             status_code=206 if byte_range else 200,
+                             media_type=job.media_type, headers=headers)
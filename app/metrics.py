@@ -0,0 +1,116 @@
+import time
+
+from elasticsearch import AsyncTransport
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+REQUEST_LATENCY = Histogram(
+    'portal_request_seconds', 'End to end latency of an endpoint',
+    ['endpoint'])
+PHASE_LATENCY = Histogram(
+    'portal_request_phase_seconds',
+    'Latency of an endpoint split into query_build, es_took, es_network '
+    'and serialization',
+    ['endpoint', 'phase'])
+ES_IN_FLIGHT = Gauge(
+    'portal_es_requests_in_flight', 'Elasticsearch requests in flight')
+ES_REQUESTS = Counter(
+    'portal_es_requests_total', 'Elasticsearch requests', ['method', 'result'])
+ES_RETRIES = Counter(
+    'portal_es_retries_total', 'Retried Elasticsearch calls', ['profile'])
+ES_HEDGED = Counter(
+    'portal_es_hedged_total', 'Hedged duplicate Elasticsearch reads',
+    ['profile'])
+ES_BREAKER_OPEN = Gauge(
+    'portal_es_circuit_open', '1 while the Elasticsearch circuit is open')
+SCHEDULER_QUEUE_WAIT = Histogram(
+    'portal_scheduler_queue_wait_seconds',
+    'Time ES calls waited for a slot in their scheduler pool', ['pool'])
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    'portal_scheduler_queue_depth', 'ES calls waiting for a slot', ['pool'])
+SCHEDULER_REJECTED = Counter(
+    'portal_scheduler_rejected_total',
+    'Requests shed because a scheduler queue was full', ['pool'])
+RATE_LIMITED = Counter(
+    'portal_rate_limited_total', 'Requests refused by a rate limit',
+    ['endpoint'])
+EXPORT_ROWS = Counter(
+    'portal_export_rows_total', 'Rows written by exports',
+    ['download_option'])
+EXPORT_BYTES = Counter(
+    'portal_export_bytes_total', 'Bytes written by exports',
+    ['download_option'])
+
+
+class RequestTimer:
+    # records the phases of one request, each phase ends at the next call
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = self.last = time.perf_counter()
+
+    def phase(self, phase):
+        now = time.perf_counter()
+        PHASE_LATENCY.labels(self.endpoint, phase).observe(now - self.last)
+        self.last = now
+
+    def es(self, response):
+        # splits the time of an ES call into the server side 'took' and
+        # everything else (network, queueing, decoding)
+        now = time.perf_counter()
+        elapsed = now - self.last
+        took = min(response.get('took', 0) / 1000, elapsed)
+        PHASE_LATENCY.labels(self.endpoint, 'es_took').observe(took)
+        PHASE_LATENCY.labels(self.endpoint, 'es_network').observe(
+            elapsed - took)
+        self.last = now
+
+    def done(self):
+        REQUEST_LATENCY.labels(self.endpoint).observe(
+            time.perf_counter() - self.started)
+
+
+class InstrumentedTransport(AsyncTransport):
+    # counts every request the ES client sends, whichever endpoint made it
+    async def perform_request(self, method, url, headers=None, params=None,
+                              body=None):
+        with ES_IN_FLIGHT.track_inprogress():
+            try:
+                response = await super().perform_request(
+                    method, url, headers=headers, params=params, body=body)
+            except Exception:
+                ES_REQUESTS.labels(method, 'error').inc()
+                raise
+        ES_REQUESTS.labels(method, 'ok').inc()
+        return response
+
+
+class CacheCollector:
+    # exposes the hit/miss counters the caches keep themselves
+    def __init__(self):
+        self.caches = dict()
+
+    def collect(self):
+        requests = CounterMetricFamily(
+            'portal_cache_requests', 'Cache lookups', labels=['cache',
+                                                              'result'])
+        prefetches = CounterMetricFamily(
+            'portal_cache_prefetched_pages',
+            'Pages stored ahead of the request, and whether they were used '
+            'or left the cache unread', labels=['cache', 'result'])
+        for name, cache in self.caches.items():
+            requests.add_metric([name, 'hit'], cache.hits)
+            requests.add_metric([name, 'miss'], cache.misses)
+            if hasattr(cache, 'wasted'):
+                prefetches.add_metric([name, 'stored'], cache.stored)
+                prefetches.add_metric([name, 'used'], cache.used)
+                prefetches.add_metric([name, 'wasted'], cache.wasted)
+        yield requests
+        yield prefetches
+
+
+cache_collector = CacheCollector()
+REGISTRY.register(cache_collector)
+
+
+def register_cache(name, cache):
+    cache_collector.caches[name] = cache
@@ -0,0 +1,321 @@
+import hashlib
+import json
+from functools import lru_cache
+from typing import NamedTuple
+
+from .constants import DATA_PORTAL_AGGREGATIONS, ARTICLES_AGGREGATIONS, \
+    NESTED_RECORDS, NESTED_RECORDS_FILTERS, NESTED_RECORDS_SORT_FIELDS
+
+
+class QueryPlan(NamedTuple):
+    index: str
+    current_class: str
+    # (rank, scientific name) pairs from phylogeny_filters
+    phylogeny_filters: tuple = ()
+    # scientific names of current_class picked in the filter list
+    taxonomy_filters: tuple = ()
+    # (filter name, filter value) pairs
+    filters: tuple = ()
+    search: str = ''
+
+    @property
+    def key(self):
+        # stable across processes, unlike hash()
+        return hashlib.sha1(
+            json.dumps(self, separators=(',', ':')).encode()).hexdigest()
+
+
+def parse_plan(index, filter=None, search=None, current_class='kingdom',
+               phylogeny_filters=None):
+    # all filters are ANDed, so they are sorted to get one plan for every
+    # order the frontend sends them in
+    phylogeny = parse_lineage(phylogeny_filters)
+
+    taxonomy = list()
+    filters = list()
+    if filter:
+        for filter_item in filter.split(","):
+            if current_class in filter_item:
+                _, value = filter_item.split(":")
+                taxonomy.append(value)
+            else:
+                filter_name, filter_value = filter_item.split(":")
+                filters.append((filter_name, filter_value))
+
+    return QueryPlan(
+        index=index,
+        current_class=current_class,
+        phylogeny_filters=tuple(sorted(set(phylogeny))),
+        taxonomy_filters=tuple(sorted(set(taxonomy))),
+        filters=tuple(sorted(set(filters))),
+        # wildcard search is case insensitive
+        search=search.lower() if search else '')
+
+
+def parse_lineage(phylogeny_filters):
+    # "kingdom:Metazoa-phylum:Chordata" -> [("kingdom", "Metazoa"), ...],
+    # in the order given
+    lineage = list()
+    if phylogeny_filters:
+        for phylogeny_filter in phylogeny_filters.split("-"):
+            name, value = phylogeny_filter.split(":")
+            lineage.append((name, value))
+    return lineage
+
+
+def parse_sort(sort):
+    # converts "field1:asc,field2:desc" into an ES sort list
+    sort_list = list()
+    if not sort:
+        return sort_list
+    for sort_item in sort.split(","):
+        field, _, order = sort_item.partition(":")
+        if field:
+            sort_list.append({field: {"order": order or "asc"}})
+    return sort_list
+
+
+def taxonomy_filter(rank, value):
+    return {
+        "nested": {
+            "path": f"taxonomies.{rank}",
+            "query": {
+                "bool": {
+                    "filter": [
+                        {
+                            "term": {
+                                f"taxonomies.{rank}.scientificName": value
+                            }
+                        }
+                    ]
+                }
+            }
+        }
+    }
+
+
+def search_fields(index):
+    if 'articles' in index:
+        return ["title", "journal_name", "study_id", "organism_name"]
+    return ["organism", "commonName", "symbionts_records.organism.text",
+            "metagenomes_records.organism.text"]
+
+
+# compiled bodies are shared between requests and must not be mutated
+@lru_cache(maxsize=1024)
+def compile_query(plan):
+    if not (plan.phylogeny_filters or plan.taxonomy_filters
+            or plan.filters or plan.search):
+        return None
+
+    query = {"bool": {"filter": list()}}
+    for name, value in plan.phylogeny_filters:
+        query["bool"]["filter"].append(taxonomy_filter(name, value))
+
+    for value in plan.taxonomy_filters:
+        query["bool"]["filter"].append(
+            taxonomy_filter(plan.current_class, value))
+
+    for filter_name, filter_value in plan.filters:
+        if filter_name == 'experimentType':
+            query["bool"]["filter"].append({
+                "nested": {
+                    "path": "experiment",
+                    "query": {
+                        "bool": {
+                            "filter": {
+                                "term": {
+                                    "experiment"
+                                    ".library_construction_protocol"
+                                    ".keyword": filter_value
+                                }
+                            }
+                        }
+                    }
+                }
+            })
+        elif filter_name == 'genome_notes':
+            query["bool"]["filter"].append({
+                'nested': {'path': 'genome_notes', 'query': {
+                    'bool': {
+                        'must': [
+                            {'exists': {
+                                'field': 'genome_notes.url'}}]}}}})
+        else:
+            query["bool"]["filter"].append(
+                {"term": {filter_name: filter_value}})
+
+    # Adding search string
+    if plan.search:
+        query["bool"]["must"] = {"bool": {"should": [
+            {
+                "wildcard": {
+                    field: {
+                        "value": f"*{plan.search}*",
+                        "case_insensitive": True
+                    }
+                }
+            }
+            for field in search_fields(plan.index)
+        ]}}
+
+    return query
+
+
+@lru_cache(maxsize=64)
+def compile_aggregations(index, current_class):
+    aggs = dict()
+
+    if 'articles' in index:
+        aggregations_list = ARTICLES_AGGREGATIONS
+    else:
+        aggregations_list = DATA_PORTAL_AGGREGATIONS
+
+    for aggregation_field in aggregations_list:
+        if aggregation_field == 'images_available':
+            aggs[aggregation_field] = {
+                "terms": {"field": aggregation_field}
+            }
+        else:
+            aggs[aggregation_field] = {
+                "terms": {"field": aggregation_field + '.keyword'}
+            }
+
+    if 'data_portal' in index:
+        aggs["experiment"] = {
+            "nested": {"path": "experiment"},
+            "aggs": {
+                "library_construction_protocol": {
+                    "terms": {
+                        "field": "experiment.library_construction_protocol.keyword",
+                    },
+                    "aggs": {
+                        "distinct_docs": {
+                            "reverse_nested": {},
+                            "aggs": {
+                                "parent_doc_count": {
+                                    "cardinality": {
+                                        "field": "organism.keyword"
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+        aggs["genome_notes"] = {
+            "nested": {"path": "genome_notes"},
+            "aggs": {
+                "genome_count": {
+                    "reverse_nested": {},  # get to the parent document level
+                    "aggs": {
+                        "distinct_docs": {
+                            "cardinality": {
+                                "field": "organism.keyword"
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+    aggs["taxonomies"] = {
+        "nested": {"path": f"taxonomies.{current_class}"},
+        "aggs": {current_class: {
+            "terms": {
+                "field": f"taxonomies.{current_class}.scientificName"
+            }
+        }
+        }
+    }
+    return aggs
+
+
+def with_search_ids(query, ids):
+    # swaps the wildcard search of a compiled query for an ids query,
+    # the compiled query itself is left untouched
+    bool_query = dict(query["bool"])
+    bool_query["must"] = {"ids": {"values": sorted(ids)}}
+    return {"bool": bool_query}
+
+
+def with_ids_filter(query, ids):
+    # adds an ids filter to a compiled query (or None), which is left
+    # untouched
+    clause = {"ids": {"values": sorted(ids)}}
+    if query is None:
+        return {"bool": {"filter": [clause]}}
+    bool_query = dict(query["bool"])
+    bool_query["filter"] = list(bool_query.get("filter", [])) + [clause]
+    return {"bool": bool_query}
+
+
+@lru_cache(maxsize=1)
+def compile_details_aggregations():
+    aggs = dict()
+    for path, aggregation_name in NESTED_RECORDS.items():
+        aggs[aggregation_name] = {
+            'nested': {'path': path},
+            "aggs": {
+                filter_aggregation: {
+                    'terms': {
+                        'field': f'{path}.{field}.keyword',
+                        'size': 2000}}
+                for field, filter_aggregation in NESTED_RECORDS_FILTERS.items()
+            }}
+    return aggs
+
+
+def compile_records_query(path, filter=None, sort=None, offset=0, limit=15):
+    # nested query returning one page of the records of an organism as
+    # inner_hits, format of filter: sex:female,organismPart:leaf
+    filters = list()
+    if filter:
+        for filter_item in filter.split(","):
+            # values may contain a colon themselves
+            filter_name, _, filter_value = filter_item.partition(":")
+            filters.append(
+                {"term": {f"{path}.{filter_name}.keyword": filter_value}})
+
+    sort_list = list()
+    for sort_item in parse_sort(sort):
+        (field, order), = sort_item.items()
+        field = NESTED_RECORDS_SORT_FIELDS[field]
+        sort_list.append({f"{path}.{field}": order})
+
+    return {
+        "nested": {
+            "path": path,
+            "query": {"bool": {"filter": filters}},
+            "score_mode": "none",
+            "inner_hits": {
+                "from": offset,
+                "size": limit,
+                "sort": sort_list
+            }
+        }
+    }
+
+
+def page_records(records, filter=None, sort=None, offset=0, limit=15):
+    # the page compile_records_query would return, from the record array
+    # of _source, for pages beyond index.max_inner_result_window
+    if filter:
+        for filter_item in filter.split(","):
+            filter_name, _, filter_value = filter_item.partition(":")
+            records = [record for record in records
+                       if record.get(filter_name) == filter_value]
+    # stable sorts from the last sort field to the first, records without
+    # the field last like in ES
+    for sort_item in reversed(parse_sort(sort)):
+        (field, order), = sort_item.items()
+        present = [record for record in records
+                   if record.get(field) is not None]
+        missing = [record for record in records
+                   if record.get(field) is None]
+        present.sort(key=lambda record: str(record[field]),
+                     reverse=order["order"] == "desc")
+        records = present + missing
+    return len(records), records[offset:offset + limit]
@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import contextlib
+import math
+import time
+
+from .metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_QUEUE_WAIT, \
+    SCHEDULER_REJECTED
+
+
+class Rejected(Exception):
+    # turned into a response with Retry-After by the app
+    def __init__(self, status_code, retry_after, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class Pool:
+    def __init__(self, name, priority, concurrency, max_queue):
+        self.name = name
+        # lower runs first when both pools are waiting for capacity
+        self.priority = priority
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.queue = collections.deque()
+
+
+class Scheduler:
+    # caps the ES calls running at once, every call runs in a pool with its
+    # own limit and queue, freed capacity goes to the pool with the best
+    # priority first
+    def __init__(self, capacity, retry_after=1):
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.running = 0
+        self.pools = dict()
+
+    def add_pool(self, name, priority, concurrency, max_queue):
+        self.pools[name] = Pool(name, priority, concurrency, max_queue)
+
+    def _available(self, pool):
+        return self.running < self.capacity and \
+            pool.running < pool.concurrency
+
+    def _start(self, pool):
+        self.running += 1
+        pool.running += 1
+
+    def admit(self, name):
+        # load shedding for new work that will queue in the pool later
+        pool = self.pools[name]
+        if len(pool.queue) >= pool.max_queue:
+            SCHEDULER_REJECTED.labels(name).inc()
+            raise Rejected(503, self.retry_after,
+                           "Service is busy, try again later")
+
+    async def acquire(self, name, shed=True):
+        pool = self.pools[name]
+        if not pool.queue and self._available(pool):
+            self._start(pool)
+            SCHEDULER_QUEUE_WAIT.labels(name).observe(0)
+            return
+        if shed:
+            self.admit(name)
+        future = asyncio.get_running_loop().create_future()
+        pool.queue.append(future)
+        SCHEDULER_QUEUE_DEPTH.labels(name).set(len(pool.queue))
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just before the cancellation
+                self.release(name)
+            elif future in pool.queue:
+                pool.queue.remove(future)
+            raise
+        finally:
+            SCHEDULER_QUEUE_DEPTH.labels(name).set(len(pool.queue))
+        SCHEDULER_QUEUE_WAIT.labels(name).observe(
+            time.perf_counter() - started)
+
+    def release(self, name):
+        pool = self.pools[name]
+        self.running -= 1
+        pool.running -= 1
+        self._wake()
+
+    def _wake(self):
+        for pool in sorted(self.pools.values(),
+                           key=lambda pool: pool.priority):
+            while pool.queue and self._available(pool):
+                future = pool.queue.popleft()
+                if future.cancelled():
+                    continue
+                self._start(pool)
+                future.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, name, shed=True):
+        await self.acquire(name, shed)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+
+class RateLimiter:
+    # token bucket per client, `rate` tokens per second up to `burst`
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> (tokens, last update), least recently seen first
+        self.buckets = collections.OrderedDict()
+
+    def check(self, client):
+        # takes a token, returns 0 or the seconds until one is available
+        if self.rate <= 0:
+            # no refill, the limit is off
+            return 0
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        retry_after = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = math.ceil((1 - tokens) / self.rate)
+        self.buckets[client] = (tokens, now)
+        if len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return retry_after
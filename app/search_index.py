@@ -0,0 +1,133 @@
+import array
+import asyncio
+import bisect
+import heapq
+import time
+
+from .export import fetch_data_in_batches
+
+NGRAM = 3
+
+
+def source_values(source, path):
+    # walks a dotted _source path, flattening lists on the way
+    values = [source]
+    for part in path.split("."):
+        next_values = list()
+        for value in values:
+            if isinstance(value, list):
+                value = [item.get(part) for item in value
+                         if isinstance(item, dict)]
+                next_values.extend(value)
+            elif isinstance(value, dict):
+                next_values.append(value.get(part))
+        values = next_values
+    flat = list()
+    for value in values:
+        if isinstance(value, list):
+            flat.extend(value)
+        elif value is not None:
+            flat.append(value)
+    return [str(value) for value in flat if value != '']
+
+
+def ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class NameIndex:
+    # case-insensitive substring index over the searchable names of an ES
+    # index, resolving a search string to the ids of matching documents
+    def __init__(self, index, fields):
+        self.index = index
+        self.fields = fields
+        self.names = list()
+        self.lower_names = list()
+        self.name_ids = list()
+        self.postings = dict()
+        # lower case names in sorted order and their positions, for prefixes
+        # shorter than a gram
+        self.sorted_names = list()
+        self.sorted_positions = array.array('I')
+        self.built_at = None
+        # version of the index it was built from, when known
+        self.version = None
+        self._positions = dict()
+
+    def add(self, doc_id, name):
+        lower_name = name.lower()
+        position = self._positions.get(lower_name)
+        if position is None:
+            position = len(self.names)
+            self._positions[lower_name] = position
+            self.names.append(name)
+            self.lower_names.append(lower_name)
+            self.name_ids.append(set())
+            for gram in ngrams(lower_name):
+                self.postings.setdefault(
+                    gram, array.array('I')).append(position)
+        self.name_ids[position].add(doc_id)
+
+    async def build(self, es, batch_size=5000):
+        async for batch in fetch_data_in_batches(es, self.index, None,
+                                                 batch_size=batch_size,
+                                                 source=self.fields):
+            for hit in batch:
+                for field in self.fields:
+                    for name in source_values(hit.get('_source', {}),
+                                              field):
+                        self.add(hit['_id'], name)
+            # let other requests run between two batches
+            await asyncio.sleep(0)
+        self._positions = dict()
+        self.name_ids = [tuple(ids) for ids in self.name_ids]
+        order = sorted(range(len(self.lower_names)),
+                       key=self.lower_names.__getitem__)
+        self.sorted_names = [self.lower_names[position] for position in order]
+        self.sorted_positions = array.array('I', order)
+        self.built_at = time.time()
+        return self
+
+    def match(self, search):
+        search = search.lower()
+        if len(search) < NGRAM:
+            candidates = range(len(self.lower_names))
+        else:
+            # every gram of the search string has to be in a matching name,
+            # so the rarest gram gives the smallest candidate list
+            postings = [self.postings.get(gram) for gram in ngrams(search)]
+            if not all(postings):
+                return []
+            candidates = min(postings, key=len)
+        return [position for position in candidates
+                if search in self.lower_names[position]]
+
+    def lookup(self, search):
+        ids = set()
+        for position in self.match(search):
+            ids.update(self.name_ids[position])
+        return ids
+
+    def starting_with(self, prefix):
+        # positions of the names starting with prefix, by binary search
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = bisect.bisect_left(self.sorted_names,
+                                 prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return self.sorted_positions[start:end]
+
+    def suggest(self, prefix, limit=10):
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        if len(prefix) < NGRAM:
+            # a substring match would scan every name, short prefixes only
+            # suggest names starting with them
+            positions = self.starting_with(prefix)
+        else:
+            positions = self.match(prefix)
+        # names starting with the prefix first, then the shortest ones
+        positions = heapq.nsmallest(limit, positions, key=lambda position: (
+            not self.lower_names[position].startswith(prefix),
+            len(self.lower_names[position]),
+            self.lower_names[position]))
+        return [self.names[position] for position in positions]
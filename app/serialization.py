@@ -0,0 +1,24 @@
+import orjson
+from elasticsearch import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+
+class OrjsonSerializer(JSONSerializer):
+    # drop-in replacement of the ES client serializer, decoding the search
+    # responses is most of the CPU time of a listing request
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            # the transport joins bulk/msearch lines as str
+            return orjson.dumps(data, default=self.default).decode('utf-8')
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+from .export import fetch_data_in_batches
+
+
+def scientific_name(taxon):
+    # a rank of the taxonomies object is a nested object or a list of them
+    if isinstance(taxon, list):
+        taxon = taxon[0] if taxon else None
+    if isinstance(taxon, dict) and taxon.get('scientificName'):
+        return str(taxon['scientificName'])
+    return None
+
+
+class TaxonNode:
+    __slots__ = ('rank', 'name', 'start', 'end', 'children')
+
+    def __init__(self, rank, name, start):
+        self.rank = rank
+        self.name = name
+        # documents below the node are ids[start:end] of the tree
+        self.start = start
+        self.end = start
+        # (rank, scientific name) -> TaxonNode
+        self.children = dict()
+
+    @property
+    def count(self):
+        return self.end - self.start
+
+    def to_dict(self):
+        # documents without a name for the rank have an unnamed node, its
+        # path element is "rank:"
+        return {'rank': self.rank, 'name': self.name or None,
+                'count': self.count, 'leaf': not self.children}
+
+
+class TaxonomyTree:
+    # taxonomy of the documents of an ES index, documents are sorted by
+    # their lineage so every node owns one contiguous range of ids. Every
+    # level of the tree is one of ranks, whichever other ranks a document has
+    def __init__(self, index, ranks):
+        self.index = index
+        self.ranks = ranks
+        self.ids = list()
+        self.root = TaxonNode(None, None, 0)
+        # (rank, scientific name) -> nodes, one per lineage it appears in
+        self.nodes = dict()
+        self.built_at = None
+        # version of the index it was built from, when known
+        self.version = None
+
+    async def build(self, es, batch_size=5000):
+        lineages = list()
+        async for batch in fetch_data_in_batches(es, self.index, None,
+                                                 batch_size=batch_size,
+                                                 source=['taxonomies']):
+            for hit in batch:
+                taxonomies = hit.get('_source', {}).get('taxonomies') or {}
+                lineage = [(rank, scientific_name(taxonomies.get(rank)) or '')
+                           for rank in self.ranks]
+                # a missing rank above a named one keeps an unnamed node,
+                # so the ranks below stay at their level
+                while lineage and not lineage[-1][1]:
+                    lineage.pop()
+                lineages.append((tuple(lineage), hit['_id']))
+            # let other requests run between two batches
+            await asyncio.sleep(0)
+
+        lineages.sort()
+        self.ids = [doc_id for _, doc_id in lineages]
+        self.root.end = len(lineages)
+        for position, (lineage, _) in enumerate(lineages):
+            node = self.root
+            for key in lineage:
+                child = node.children.get(key)
+                if child is None:
+                    child = TaxonNode(key[0], key[1], position)
+                    node.children[key] = child
+                    self.nodes.setdefault(key, []).append(child)
+                child.end = position + 1
+                node = child
+        self.built_at = time.time()
+        return self
+
+    def find(self, lineage):
+        # node at the end of a list of (rank, scientific name) pairs
+        node = self.root
+        for key in lineage:
+            node = node.children.get(key)
+            if node is None:
+                return None
+        return node
+
+    def children(self, node):
+        children = sorted(node.children.values(),
+                          key=lambda child: (-child.count, child.name))
+        return [child.to_dict() for child in children]
+
+    def resolves(self, filters):
+        # other ranks aren't in the tree, and unnamed nodes don't match a
+        # nested query, those filters stay ES queries
+        return all(rank in self.ranks and name for rank, name in filters)
+
+    def count(self, filters):
+        # upper bound of resolve(filters), without building the id set
+        counts = [sum(node.count for node in self.nodes.get(key, ()))
+                  for key in filters]
+        return min(counts) if counts else len(self.ids)
+
+    def resolve(self, filters):
+        # ids of the documents matching every (rank, scientific name) pair
+        positions = None
+        for key in filters:
+            matched = set()
+            for node in self.nodes.get(key, ()):
+                matched.update(range(node.start, node.end))
+            positions = matched if positions is None else positions & matched
+        if positions is None:
+            return set(self.ids)
+        return {self.ids[position] for position in positions}
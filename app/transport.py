@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import operator
+import random
+import time
+
+import aiohttp
+from elasticsearch import AsyncElasticsearch, AIOHttpConnection, \
+    ConnectionError, ConnectionTimeout, TransportError
+from elasticsearch._async.http_aiohttp import ESClientResponse
+
+from .metrics import ES_BREAKER_OPEN, ES_HEDGED, ES_RETRIES, \
+    InstrumentedTransport
+from .scheduler import Rejected
+from .serialization import OrjsonSerializer
+
+logger = logging.getLogger(__name__)
+
+# statuses worth another try, everything else is the caller's problem
+RETRY_STATUSES = (429, 502, 503, 504)
+# client calls that only read and can safely be sent twice
+HEDGED_METHODS = ('search', 'get', 'mget', 'msearch')
+# namespaced client APIs, es.indices.stats(...) calls 'indices.stats'
+NAMESPACES = ('indices', 'cluster')
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Elasticsearch is unavailable")
+        self.retry_after = retry_after
+
+
+class PortalConnection(AIOHttpConnection):
+    # AIOHttpConnection with a configurable keep-alive of idle connections
+    def __init__(self, *args, keepalive_timeout=15, **kwargs):
+        self.keepalive_timeout = keepalive_timeout
+        super().__init__(*args, **kwargs)
+
+    async def _create_aiohttp_session(self):
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=("accept", "accept-encoding"),
+            auto_decompress=True,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(
+                limit=self._limit, use_dns_cache=True, ssl=self._ssl_context,
+                keepalive_timeout=self.keepalive_timeout
+            ),
+        )
+
+
+def is_unavailable(error):
+    # errors that count against the circuit breaker
+    if isinstance(error, ConnectionError):
+        return True
+    return isinstance(error, TransportError) and \
+        error.status_code in RETRY_STATUSES
+
+
+def is_retryable(error):
+    # a timed out query is not sent again, ES is already slow and the
+    # heaviest queries are the ones that time out
+    return is_unavailable(error) and \
+        not isinstance(error, ConnectionTimeout)
+
+
+class CircuitBreaker:
+    # opens after `threshold` failed calls in a row, then lets one trial
+    # call through every `cooldown` seconds until a call succeeds again
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        remaining = self.opened_at + self.cooldown - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(remaining)
+        # this call is the trial, everybody else keeps failing fast until
+        # it succeeds or another cooldown has passed
+        self.opened_at = time.monotonic()
+
+    def success(self):
+        self.failures = 0
+        if self.opened_at is not None:
+            logger.info("Elasticsearch circuit closed")
+            self.opened_at = None
+            ES_BREAKER_OPEN.set(0)
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning("Elasticsearch circuit opened after %d "
+                               "failures", self.failures)
+            self.opened_at = time.monotonic()
+            ES_BREAKER_OPEN.set(1)
+
+
+class Profile:
+    def __init__(self, name, timeout, hedge=False, pool=None, shed=True):
+        self.name = name
+        self.timeout = timeout
+        self.hedge = hedge
+        # scheduler pool of the calls, only shed when the queue is full if
+        # `shed`, running exports keep queueing instead
+        self.pool = pool
+        self.shed = shed
+        self.latencies = collections.deque(maxlen=200)
+
+    def p95(self):
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+
+class ResilientElasticsearch:
+    # the ES client used by the service: created and closed with the app,
+    # with retries, per-profile timeouts, hedged reads and a circuit breaker
+    def __init__(self, hosts, http_auth=None, pool_size=10, keepalive=15,
+                 listing_timeout=10, export_timeout=120, max_retries=2,
+                 backoff=0.1, max_backoff=2, hedge=True, hedge_min_delay=0.05,
+                 hedge_min_samples=20, breaker_threshold=5,
+                 breaker_cooldown=30, scheduler=None):
+        self.hosts = hosts
+        self.http_auth = http_auth
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.scheduler = scheduler
+        self.profiles = {
+            'listing': Profile('listing', listing_timeout, hedge,
+                               pool='interactive'),
+            'export': Profile('export', export_timeout, pool='bulk',
+                              shed=False),
+        }
+        self.client = None
+
+    async def start(self):
+        # an already attached client (e.g. a stand-in) is kept
+        if self.client is None:
+            self.client = AsyncElasticsearch(
+                self.hosts,
+                connection_class=PortalConnection,
+                transport_class=InstrumentedTransport,
+                serializer=OrjsonSerializer(),
+                http_auth=self.http_auth,
+                maxsize=self.pool_size,
+                keepalive_timeout=self.keepalive,
+                # retries are done here, with backoff
+                max_retries=0,
+                use_ssl=True, verify_certs=False)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def profile(self, name):
+        return ProfileClient(self, self.profiles[name])
+
+    def __getattr__(self, method):
+        # es.search(...) etc. use the listing profile
+        return getattr(self.profile('listing'), method)
+
+    async def call(self, profile, method, args, kwargs):
+        self.breaker.before_call()
+        kwargs.setdefault('request_timeout', profile.timeout)
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(profile):
+                    started = time.perf_counter()
+                    if profile.hedge and method in HEDGED_METHODS:
+                        result = await self.hedged(profile, method, args,
+                                                   kwargs)
+                    else:
+                        result = await operator.attrgetter(method)(
+                            self.client)(*args, **kwargs)
+            except Rejected:
+                raise
+            except Exception as e:
+                if not is_unavailable(e):
+                    # the request itself is wrong, ES is fine
+                    self.breaker.success()
+                    raise
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    self.breaker.failure()
+                    raise
+                attempt += 1
+                ES_RETRIES.labels(profile.name).inc()
+                # full jitter keeps retrying clients from moving in lockstep
+                await asyncio.sleep(random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                continue
+            profile.latencies.append(time.perf_counter() - started)
+            self.breaker.success()
+            return result
+
+    def slot(self, profile):
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(profile.pool, profile.shed)
+
+    async def hedged(self, profile, method, args, kwargs):
+        # a second identical request is sent when the first one is slower
+        # than the recent p95, whichever answers first wins
+        func = operator.attrgetter(method)(self.client)
+        if len(profile.latencies) < self.hedge_min_samples:
+            return await func(*args, **kwargs)
+        delay = max(profile.p95(), self.hedge_min_delay)
+        primary = asyncio.ensure_future(func(*args, **kwargs))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+
+            ES_HEDGED.labels(profile.name).inc()
+            pending.add(asyncio.ensure_future(func(*args, **kwargs)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            # the losing request, or both when the caller was cancelled,
+            # must not outlive the scheduler slot of the call
+            for future in pending:
+                if not future.done():
+                    future.cancel()
+
+
+class ProfileClient:
+    # view of ResilientElasticsearch bound to one profile, exposes the client
+    # methods used by the service
+    def __init__(self, es, profile, namespace=''):
+        self.es = es
+        self.profile = profile
+        self.namespace = namespace
+
+    def __getattr__(self, method):
+        if not self.namespace and method in NAMESPACES:
+            return ProfileClient(self.es, self.profile, method + '.')
+        method = self.namespace + method
+
+        async def call(*args, **kwargs):
+            return await self.es.call(self.profile, method, args, kwargs)
+        return call
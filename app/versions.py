@@ -0,0 +1,51 @@
+import hashlib
+
+import orjson
+from elasticsearch import NotFoundError
+
+# what changes when documents are written or the index behind an alias is
+# replaced, without the size and timing stats that change on every search
+STATS_FILTER_PATH = 'indices.*.uuid,indices.*.primaries.docs,' \
+                    'indices.*.primaries.indexing.index_total,' \
+                    'indices.*.primaries.indexing.delete_total'
+
+
+def index_version(stats):
+    # the same documents give the same version on every instance
+    return hashlib.sha1(orjson.dumps(
+        stats.get('indices', {}), option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
+
+class IndexVersions:
+    # version of every index the service reads, refreshed from a cheap
+    # indices stats call. on_change(index) is called when a known version
+    # changes, so caches of the index can be dropped
+    def __init__(self, indices, on_change=None):
+        self.indices = list(indices)
+        self.on_change = on_change
+        # index name -> version, missing until the first refresh
+        self.versions = dict()
+
+    def get(self, index):
+        return self.versions.get(index)
+
+    async def refresh(self, es):
+        for index in self.indices:
+            try:
+                stats = await es.indices.stats(
+                    index=index, metric='docs,indexing',
+                    filter_path=STATS_FILTER_PATH)
+            except NotFoundError:
+                self.update(index, None)
+                continue
+            self.update(index, index_version(stats))
+
+    def update(self, index, version):
+        previous = self.versions.get(index)
+        if version is None:
+            self.versions.pop(index, None)
+        else:
+            self.versions[index] = version
+        if previous is not None and previous != version and \
+                self.on_change is not None:
+            self.on_change(index)
@@ -0,0 +1,82 @@
+"""Landing view latency: sequential listing requests vs one /dashboard call.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_dashboard --latency 0.02 --rounds 50
+
+The Elasticsearch client behind app.main.es is replaced by
+benchmarks.fake_es.FakeElasticsearch, every search or msearch costs one
+``--latency`` round trip. Each round loads the landing view once as the
+frontend does today (one request per index plus /summary, one after the
+other) and once through POST /dashboard.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.run import asgi_request, percentile
+
+INDICES = ["data_portal", "tracking_status", "articles"]
+
+
+async def sequential(app, offset):
+    for index in INDICES:
+        await asgi_request(app, "GET", f"/{index}",
+                           {"offset": offset, "limit": 15})
+    await asgi_request(app, "GET", "/summary")
+
+
+async def dashboard(app, offset):
+    queries = [{"name": index, "index": index, "offset": offset,
+                "limit": 15} for index in INDICES]
+    queries.append({"name": "summary", "index": "summary"})
+    response = await asgi_request(app, "POST", "/dashboard",
+                                  json_body={"queries": queries})
+    assert response["status"] == 200, response
+
+
+async def measure(app, load, rounds):
+    latencies = list()
+    for i in range(rounds):
+        started = time.perf_counter()
+        await load(app, (i * 15) % 900)
+        latencies.append(time.perf_counter() - started)
+    return {"p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2)}
+
+
+async def main(args):
+    from app import main as service
+
+    fake = FakeElasticsearch.with_synthetic_data(
+        args.docs, args.size, latency=args.latency, jitter=args.jitter)
+    service.es.client = fake
+    await service.app.router.startup()
+    try:
+        # warm the aggregation caches so both sides only pay for the hits
+        await measure(service.app, dashboard, 1)
+        report = dict()
+        for name, load in (("sequential", sequential),
+                           ("dashboard", dashboard)):
+            requests = fake.requests
+            report[name] = await measure(service.app, load, args.rounds)
+            report[name]["es_round_trips"] = \
+                (fake.requests - requests) / args.rounds
+    finally:
+        await service.app.router.shutdown()
+    report["speedup_p50"] = round(
+        report["sequential"]["p50_ms"] / report["dashboard"]["p50_ms"], 2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="simulated ES round trip in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rounds", type=int, default=50)
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
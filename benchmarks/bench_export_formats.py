@@ -0,0 +1,71 @@
+"""Bytes written and encode throughput of every export format.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_export_formats --docs 5000 --workers 4
+
+Synthetic data_portal documents from benchmarks.fake_es are fed straight
+into the export writers in batches, no Elasticsearch round trips are
+involved, so the numbers are the cost of row extraction and encoding only.
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app.export import available_export_formats, create_data_files
+from benchmarks.fake_es import generate_documents
+
+DOWNLOAD_OPTIONS = ["assemblies", "annotation", "raw_files", "metadata"]
+
+
+async def in_batches(documents, batch_size):
+    for start in range(0, len(documents), batch_size):
+        yield documents[start:start + batch_size]
+
+
+async def run_export(documents, download_option, export_format, batch_size,
+                     executor):
+    written = 0
+    started = time.perf_counter()
+    async for chunk in create_data_files(
+            in_batches(documents, batch_size), download_option,
+            "data_portal", export_format, executor=executor):
+        written += len(chunk)
+    elapsed = time.perf_counter() - started
+    return {"download_option": download_option, "format": export_format,
+            "bytes": written, "seconds": round(elapsed, 3),
+            "docs_per_sec": round(len(documents) / elapsed),
+            "mb_per_sec": round(written / elapsed / 1024 / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=15,
+                        help="nested records per document, a fifth of it "
+                             "are experiments")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="process pool size, 0 encodes on the loop")
+    parser.add_argument("--formats", default=",".join(
+        available_export_formats()))
+    parser.add_argument("--options", default=",".join(DOWNLOAD_OPTIONS))
+    args = parser.parse_args()
+
+    documents = generate_documents("data_portal", args.docs, args.size)
+    executor = ProcessPoolExecutor(args.workers) if args.workers else None
+    report = []
+    for download_option in args.options.split(","):
+        for export_format in args.formats.split(","):
+            report.append(asyncio.run(run_export(
+                documents, download_option, export_format, args.batch_size,
+                executor)))
+    if executor is not None:
+        executor.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Rows/sec of the sliced export engine as the slice count grows.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_export_slices --docs 20000 --latency 0.05
+
+The Elasticsearch client is replaced by benchmarks.fake_es, answering
+every search after ``--latency`` seconds, so the numbers show how well the
+slices hide ES round trips rather than the speed of a real cluster.
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.export import create_data_files, fetch_data_in_batches, \
+    fetch_data_in_slices
+from benchmarks.fake_es import FakeElasticsearch, generate_documents
+
+
+async def run_export(es, slices, batch_size, executor):
+    if slices > 1:
+        batches = fetch_data_in_slices(es, "data_portal", None,
+                                       slices=slices, concurrency=slices,
+                                       batch_size=batch_size)
+    else:
+        batches = fetch_data_in_batches(es, "data_portal", None,
+                                        batch_size=batch_size)
+    rows = 0
+    written = 0
+    started = time.perf_counter()
+    async for chunk in create_data_files(batches, "raw_files",
+                                         "data_portal",
+                                         executor=executor):
+        rows += chunk.count(b"\n")
+        written += len(chunk)
+    elapsed = time.perf_counter() - started
+    # header line is not a data row
+    rows -= 1
+    return {"slices": slices, "rows": rows, "bytes": written,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(rows / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=15,
+                        help="nested records per document, a fifth of it "
+                             "are experiments")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--slices", default="1,2,4,8")
+    args = parser.parse_args()
+
+    es = FakeElasticsearch(
+        {"data_portal": generate_documents("data_portal", args.docs,
+                                           args.size)},
+        latency=args.latency)
+    executor = ThreadPoolExecutor(args.workers) if args.workers else None
+    report = []
+    for slices in [int(s) for s in args.slices.split(",")]:
+        report.append(asyncio.run(
+            run_export(es, slices, args.batch_size, executor)))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""CPU time and bytes on the wire of a listing response, before and after.
+
+    python -m benchmarks.bench_responses --hits 1000 --rounds 20
+
+"before" is the previous path: json.loads of the ES body, then FastAPI's
+jsonable_encoder + json.dumps. "after" is orjson on both sides with the
+response returned directly. Bytes are reported for identity, gzip and br.
+"""
+import argparse
+import json
+import time
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from app.compression import Compressor, brotli
+
+
+def make_es_response(hits):
+    return {
+        "took": 12,
+        "hits": {
+            "total": {"value": hits * 10},
+            "hits": [{
+                "_index": "data_portal",
+                "_id": f"Organism {i}",
+                "_score": None,
+                "_source": {
+                    "organism": f"Organism {i}",
+                    "commonName": f"common name {i}",
+                    "currentStatus": "Annotation Complete",
+                    "tolid": [f"ilOrg{i}.{j}" for j in range(3)],
+                    "records": [{
+                        "accession": f"SAMEA{i}{j}",
+                        "sex": "female",
+                        "organismPart": "WHOLE_ORGANISM",
+                        "trackingSystem": "Done",
+                        "customFields": [{"name": f"field{k}",
+                                          "value": f"value {k}"}
+                                         for k in range(5)]
+                    } for j in range(10)],
+                    "experiment": [{
+                        "study_accession": f"PRJEB{i}",
+                        "run_accession": f"ERR{i}{j}",
+                        "fastq_ftp": f"ftp.sra.ebi.ac.uk/ERR{i}{j}.fastq.gz"
+                    } for j in range(5)]
+                }
+            } for i in range(hits)]
+        },
+        "aggregations": {
+            "biosamples": {"buckets": [{"key": "Done", "doc_count": 10}]}
+        }
+    }
+
+
+def reshape(response):
+    data = dict()
+    data['count'] = response['hits']['total']['value']
+    data['results'] = response['hits']['hits']
+    data['aggregations'] = response['aggregations']
+    return data
+
+
+def before(raw):
+    data = reshape(json.loads(raw))
+    return JSONResponse(jsonable_encoder(data)).body
+
+
+def after(raw):
+    return ORJSONResponse(reshape(orjson.loads(raw))).body
+
+
+def cpu_ms(func, raw, rounds):
+    started = time.process_time()
+    for _ in range(rounds):
+        body = func(raw)
+    return round((time.process_time() - started) / rounds * 1000, 2), body
+
+
+def compressed_size(body, encoding):
+    compressor = Compressor(encoding, 6, 4)
+    return len(compressor.compress(body) + compressor.finish())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hits", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    raw = json.dumps(make_es_response(args.hits))
+    before_ms, before_body = cpu_ms(before, raw, args.rounds)
+    after_ms, after_body = cpu_ms(after, raw, args.rounds)
+    report = {
+        "hits": args.hits,
+        "es_response_bytes": len(raw),
+        "before": {"cpu_ms": before_ms, "bytes": len(before_body)},
+        "after": {"cpu_ms": after_ms, "bytes": len(after_body),
+                  "gzip_bytes": compressed_size(after_body, "gzip")},
+    }
+    if brotli is not None:
+        report["after"]["br_bytes"] = compressed_size(after_body, "br")
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
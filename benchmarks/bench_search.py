@@ -0,0 +1,133 @@
+"""Latency of the name index search compared to leading-wildcard queries.
+
+Offline, against synthetic names (the wildcard side is a linear scan, which
+is what a leading wildcard costs ES per term dictionary):
+
+    python -m benchmarks.bench_search --names 200000
+
+Against a live cluster, using ES_CONNECTION_URL/ES_USERNAME/ES_PASSWORD,
+timing the full ES round trip of both query forms:
+
+    python -m benchmarks.bench_search --es --index data_portal
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import string
+import time
+
+from app.query import compile_query, parse_plan, search_fields, \
+    with_search_ids
+from app.search_index import NameIndex
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50_us": round(samples[len(samples) // 2] * 1e6, 1),
+        "p95_us": round(samples[int(len(samples) * 0.95)] * 1e6, 1),
+        "mean_us": round(statistics.mean(samples) * 1e6, 1),
+    }
+
+
+def random_name(rng):
+    return " ".join(
+        "".join(rng.choice(string.ascii_lowercase)
+                for _ in range(rng.randint(4, 12))).capitalize()
+        for _ in range(2))
+
+
+def synthetic(args):
+    rng = random.Random(1)
+    name_index = NameIndex("synthetic", ["organism"])
+    names = [random_name(rng) for _ in range(args.names)]
+    started = time.perf_counter()
+    for doc_id, name in enumerate(names):
+        name_index.add(str(doc_id), name)
+    build_seconds = time.perf_counter() - started
+
+    terms = [name[i:i + rng.randint(3, 8)]
+             for name in rng.sample(names, args.terms)
+             for i in [rng.randint(0, 4)]]
+    lower_names = [name.lower() for name in names]
+    index_times = list()
+    scan_times = list()
+    for term in terms:
+        started = time.perf_counter()
+        name_index.lookup(term)
+        index_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        lower_term = term.lower()
+        [name for name in lower_names if lower_term in name]
+        scan_times.append(time.perf_counter() - started)
+
+    return {"names": args.names, "build_seconds": round(build_seconds, 2),
+            "name_index": percentiles(index_times),
+            "linear_scan": percentiles(scan_times)}
+
+
+async def live(args):
+    from elasticsearch import AsyncElasticsearch
+
+    es = AsyncElasticsearch(
+        [os.getenv('ES_CONNECTION_URL')],
+        http_auth=(os.getenv('ES_USERNAME'), os.getenv('ES_PASSWORD')),
+        use_ssl=True, verify_certs=False, timeout=60)
+    try:
+        started = time.perf_counter()
+        name_index = await NameIndex(
+            args.index, search_fields(args.index)).build(es)
+        build_seconds = time.perf_counter() - started
+
+        rng = random.Random(1)
+        names = rng.sample(name_index.names,
+                           min(args.terms, len(name_index.names)))
+        terms = [name[:rng.randint(3, max(3, len(name)))] for name in names]
+        wildcard_times = list()
+        ids_times = list()
+        lookup_times = list()
+        for term in terms:
+            plan = parse_plan(args.index, search=term)
+            query = compile_query(plan)
+
+            started = time.perf_counter()
+            await es.search(index=args.index, size=15,
+                            body={"query": query})
+            wildcard_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            ids = name_index.lookup(term)
+            lookup_times.append(time.perf_counter() - started)
+            await es.search(index=args.index, size=15,
+                            body={"query": with_search_ids(query, ids)})
+            ids_times.append(time.perf_counter() - started)
+
+        return {"index": args.index, "names": len(name_index.names),
+                "build_seconds": round(build_seconds, 2),
+                "wildcard_query": percentiles(wildcard_times),
+                "name_index_lookup": percentiles(lookup_times),
+                "name_index_query": percentiles(ids_times)}
+    finally:
+        await es.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--es", action="store_true")
+    parser.add_argument("--index", default="data_portal")
+    parser.add_argument("--names", type=int, default=100000)
+    parser.add_argument("--terms", type=int, default=200)
+    args = parser.parse_args()
+    if args.es:
+        report = asyncio.run(live(args))
+    else:
+        report = synthetic(args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""In-memory stand-in for the AsyncElasticsearch client.
+
+Serves synthetic data_portal, tracking_status, articles and summary
+documents and answers after a simulated latency. Only the query features
+the service uses are evaluated (bool/term/terms/ids/nested/wildcard), the
+aggregations are answered with synthetic buckets.
+"""
+import asyncio
+import copy
+import itertools
+import random
+
+from elasticsearch import NotFoundError
+
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus",
+         "species"]
+
+
+def taxonomies(rng, i):
+    # like the real taxonomies object every document has some ranks outside
+    # RANKS, and some of RANKS are missing
+    taxonomy = {"superkingdom": {"scientificName": "Eukaryota"}}
+    for depth, rank in enumerate(RANKS):
+        if rank == "class" and i % 5 == 0:
+            continue
+        # few kingdoms, many species
+        width = 3 ** (depth + 1)
+        taxonomy[rank] = {"scientificName": f"{rank.title()} {i % width}"}
+        if rank == "phylum" and i % 2 == 0:
+            taxonomy["subphylum"] = {"scientificName": f"Subphylum {i % 9}"}
+    return taxonomy
+
+
+def records(rng, i, count):
+    return [{
+        "accession": f"SAMEA{i:06d}{j:03d}",
+        "organism": {"text": f"Organism {i}"},
+        "sex": rng.choice(["female", "male", "not collected"]),
+        "organismPart": rng.choice(["WHOLE_ORGANISM", "MUSCLE", "LEAF"]),
+        "trackingSystem": rng.choice(["Submitted to BioSamples", "Done"]),
+        "commonName": f"common name {i}",
+    } for j in range(count)]
+
+
+def data_portal_document(rng, i, size):
+    return {
+        "organism": f"Organism {i}",
+        "commonName": f"common name {i}",
+        "commonNameSource": "UKSI",
+        "currentStatus": rng.choice(["Submitted to BioSamples",
+                                     "Raw Data - Submitted",
+                                     "Annotation Complete"]),
+        "biosamples": "Done",
+        "raw_data": rng.choice(["Done", "Waiting"]),
+        "mapped_reads": "Waiting",
+        "assemblies_status": rng.choice(["Done", "Waiting"]),
+        "annotation_status": "Waiting",
+        "annotation_complete": "Waiting",
+        "project_name": ["DToL"],
+        "images_available": rng.random() > 0.5,
+        "tolid": [f"ilOrg{i}.{j}" for j in range(2)],
+        "taxonomies": taxonomies(rng, i),
+        "records": records(rng, i, size),
+        "symbionts_records": records(rng, i, size // 10),
+        "metagenomes_records": records(rng, i, size // 10),
+        "experiment": [{
+            "study_accession": f"PRJEB{i}",
+            "sample_accession": f"SAMEA{i:06d}{j:03d}",
+            "experiment_accession": f"ERX{i}{j}",
+            "run_accession": f"ERR{i}{j}",
+            "tax_id": str(i),
+            "scientific_name": f"Organism {i}",
+            "fastq_ftp": f"ftp.sra.ebi.ac.uk/ERR{i}{j}_1.fastq.gz;"
+                         f"ftp.sra.ebi.ac.uk/ERR{i}{j}_2.fastq.gz",
+            "submitted_ftp": "",
+            "sra-ftp": f"ftp.sra.ebi.ac.uk/ERR{i}{j}",
+            "library_construction_protocol": rng.choice(["Hi-C", "PacBio"])
+        } for j in range(max(size // 5, 1))],
+        "assemblies": [{
+            "accession": f"GCA_{i:09d}.{j}",
+            "version": j,
+            "assembly_name": f"ilOrg{i}.{j}",
+            "description": "primary haplotype"
+        } for j in range(2)],
+        "annotation": [{
+            "annotation": {"GTF": f"https://ftp/{i}.gtf.gz",
+                           "GFF3": f"https://ftp/{i}.gff3.gz"},
+            "proteins": {"FASTA": f"https://ftp/{i}.pep.fa.gz"},
+            "transcripts": {"FASTA": f"https://ftp/{i}.cdna.fa.gz"},
+            "softmasked_genome": {"FASTA": f"https://ftp/{i}.sm.fa.gz"}
+        }],
+        "genome_notes": [{"url": f"https://notes/{i}"}] if i % 7 == 0 else []
+    }
+
+
+def tracking_status_document(rng, i, size):
+    document = data_portal_document(rng, i, 0)
+    return {key: document[key] for key in (
+        "organism", "commonName", "biosamples", "raw_data", "mapped_reads",
+        "assemblies_status", "annotation_status", "annotation_complete",
+        "taxonomies", "tolid")}
+
+
+def articles_document(rng, i, size):
+    return {
+        "title": f"The genome sequence of Organism {i}",
+        "journal_name": "Wellcome Open Research",
+        "journalTitle": "Wellcome Open Research",
+        "study_id": f"PRJEB{i}",
+        "organism_name": f"Organism {i}",
+        "pubYear": str(2020 + i % 5),
+        "articleType": "Data Note",
+    }
+
+
+def summary_document(rng, i, size):
+    return {"name": f"summary {i}", "count": rng.randint(0, 10000)}
+
+
+GENERATORS = {
+    "data_portal": data_portal_document,
+    "tracking_status": tracking_status_document,
+    "articles": articles_document,
+    "summary": summary_document,
+}
+
+
+def generate_documents(index, count, size, seed=1):
+    rng = random.Random(seed)
+    generator = GENERATORS[index]
+    documents = list()
+    for i in range(count):
+        source = generator(rng, i, size)
+        doc_id = source.get("organism", source.get("study_id", str(i)))
+        documents.append({"_index": index, "_type": "_doc", "_id": doc_id,
+                          "_score": None, "_source": source})
+    return documents
+
+
+def field_values(source, path):
+    values = [source]
+    for part in path.split("."):
+        next_values = list()
+        for value in values:
+            items = value if isinstance(value, list) else [value]
+            for item in items:
+                if isinstance(item, dict) and part in item:
+                    next_values.append(item[part])
+        values = next_values
+    flat = list()
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+
+def matches(document, query):
+    if not query:
+        return True
+    (kind, clause), = query.items()
+    source = document["_source"]
+    if kind == "bool":
+        for occur in ("filter", "must"):
+            clauses = clause.get(occur, [])
+            clauses = clauses if isinstance(clauses, list) else [clauses]
+            if not all(matches(document, item) for item in clauses):
+                return False
+        should = clause.get("should", [])
+        should = should if isinstance(should, list) else [should]
+        if should and "filter" not in clause and "must" not in clause:
+            return any(matches(document, item) for item in should)
+        return True
+    if kind in ("term", "terms"):
+        (field, expected), = clause.items()
+        expected = expected if isinstance(expected, list) else [expected]
+        if isinstance(expected[0], dict):
+            expected = [expected[0].get("value")]
+        field = field.replace(".keyword", "")
+        values = field_values(source, field)
+        return any(value in expected for value in values)
+    if kind == "ids":
+        return document["_id"] in clause["values"]
+    if kind == "wildcard":
+        (field, expected), = clause.items()
+        needle = expected["value"].strip("*").lower()
+        return any(needle in str(value).lower()
+                   for value in field_values(source, field))
+    if kind == "nested":
+        return True
+    if kind == "exists":
+        return bool(field_values(source, clause["field"]))
+    return True
+
+
+def aggregation_result(aggregation):
+    if "nested" in aggregation or "reverse_nested" in aggregation:
+        result = {"doc_count": 100}
+        for name, sub in aggregation.get("aggs", {}).items():
+            result[name] = aggregation_result(sub)
+        return result
+    if "cardinality" in aggregation:
+        return {"value": 42}
+    buckets = list()
+    for i in range(5):
+        bucket = {"key": f"value {i}", "doc_count": 100 - i}
+        for name, sub in aggregation.get("aggs", {}).items():
+            bucket[name] = aggregation_result(sub)
+        buckets.append(bucket)
+    return {"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0,
+            "buckets": buckets}
+
+
+class FakeElasticsearch:
+    def __init__(self, documents=None, latency=0.005, jitter=0.0,
+                 seed=1):
+        # index name -> list of documents
+        self.documents = documents or dict()
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.pits = dict()
+        self.pit_ids = itertools.count()
+        self.requests = 0
+        self.indices = FakeIndices(self)
+
+    @classmethod
+    def with_synthetic_data(cls, count=1000, size=20, **kwargs):
+        documents = {
+            "data_portal": generate_documents("data_portal", count, size),
+            "tracking_status": generate_documents("tracking_status", count,
+                                                  size),
+            "articles": generate_documents("articles", count, size),
+            "summary": generate_documents("summary", 10, size),
+        }
+        return cls(documents, **kwargs)
+
+    async def _wait(self):
+        self.requests += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        await asyncio.sleep(delay)
+
+    def _documents(self, index):
+        if index not in self.documents:
+            raise NotFoundError(404, "index_not_found_exception",
+                                {"error": f"no such index [{index}]"})
+        return self.documents[index]
+
+    async def open_point_in_time(self, index, keep_alive=None, **params):
+        await self._wait()
+        pit_id = f"pit-{next(self.pit_ids)}"
+        self.pits[pit_id] = index
+        return {"id": pit_id}
+
+    async def close_point_in_time(self, body=None, **params):
+        await self._wait()
+        if self.pits.pop(body["id"], None) is None:
+            raise NotFoundError(404, "search_context_missing_exception", {})
+        return {"succeeded": True, "num_freed": 1}
+
+    async def search(self, body=None, index=None, sort=None, from_=None,
+                     size=None, q=None, **params):
+        await self._wait()
+        return self._search(body, index, from_, size)
+
+    async def msearch(self, body, index=None, **params):
+        # one simulated round trip for all searches
+        await self._wait()
+        responses = list()
+        for header, search in zip(body[::2], body[1::2]):
+            try:
+                response = self._search(search, header.get("index", index))
+            except NotFoundError as e:
+                response = {"error": e.info, "status": e.status_code}
+            else:
+                response["status"] = 200
+            responses.append(response)
+        return {"took": int(self.latency * 1000), "responses": responses}
+
+    def _search(self, body=None, index=None, from_=None, size=None):
+        body = body or dict()
+        if "pit" in body:
+            if body["pit"]["id"] not in self.pits:
+                raise NotFoundError(404, "search_context_missing_exception",
+                                    {})
+            index = self.pits[body["pit"]["id"]]
+        documents = self._documents(index)
+
+        positions = [position for position, document in enumerate(documents)
+                     if matches(document, body.get("query"))]
+        if "slice" in body:
+            positions = positions[body["slice"]["id"]::body["slice"]["max"]]
+        start = from_ if from_ is not None else body.get("from", 0)
+        if body.get("search_after"):
+            last = body["search_after"][-1]
+            start = next((i for i, position in enumerate(positions)
+                          if position > last), len(positions))
+        size = size if size is not None else body.get("size", 10)
+
+        hits = list()
+        for position in positions[start:start + size]:
+            hit = copy.copy(documents[position])
+            hit["sort"] = [position]
+            if body.get("_source") is not None:
+                hit["_source"] = project(hit["_source"], body["_source"])
+            hits.append(hit)
+
+        response = {
+            "took": int(self.latency * 1000),
+            "timed_out": False,
+            "hits": {"total": {"value": len(positions), "relation": "eq"},
+                     "max_score": None, "hits": hits}
+        }
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        if body.get("aggs"):
+            response["aggregations"] = {
+                name: aggregation_result(aggregation)
+                for name, aggregation in body["aggs"].items()}
+        return response
+
+    async def count(self, body=None, index=None, **params):
+        await self._wait()
+        query = (body or dict()).get("query")
+        return {"count": sum(1 for document in self._documents(index)
+                             if matches(document, query))}
+
+    async def get(self, index, id, _source_includes=None, **params):
+        await self._wait()
+        for document in self._documents(index):
+            if document["_id"] == id:
+                return dict(document, found=True, _version=1)
+        raise NotFoundError(404, "not_found",
+                            {"_index": index, "_id": id, "found": False})
+
+    async def mget(self, body, index=None, _source_includes=None, **params):
+        await self._wait()
+        documents = {document["_id"]: document
+                     for document in self._documents(index)}
+        return {"docs": [
+            dict(documents[doc_id], found=True, _version=1)
+            if doc_id in documents
+            else {"_index": index, "_id": doc_id, "found": False}
+            for doc_id in body["ids"]]}
+
+    async def close(self):
+        pass
+
+
+class FakeIndices:
+    # es.indices, index stats only count the documents and the reloads
+    def __init__(self, es):
+        self.es = es
+        # index name -> number of simulated reloads
+        self.reloads = dict()
+
+    def reload(self, index):
+        # what an ingestion run looks like to the version check
+        self.reloads[index] = self.reloads.get(index, 0) + 1
+
+    async def stats(self, index=None, metric=None, **params):
+        await self.es._wait()
+        documents = self.es._documents(index)
+        writes = len(documents) + self.reloads.get(index, 0)
+        return {"indices": {index: {
+            "uuid": f"{index}-uuid",
+            "primaries": {
+                "docs": {"count": len(documents), "deleted": 0},
+                "indexing": {"index_total": writes, "delete_total": 0}}}}}
+
+
+def project(source, includes):
+    if isinstance(includes, dict):
+        excludes = includes.get("excludes", [])
+        includes = includes.get("includes")
+        source = {key: value for key, value in source.items()
+                  if key not in excludes}
+        if not includes:
+            return source
+    projected = dict()
+    for field in includes:
+        top = field.split(".")[0]
+        if top in source:
+            projected[top] = source[top]
+    return projected
@@ -0,0 +1,235 @@
+"""Offline benchmark of the service against an in-memory Elasticsearch.
+
+Run from the repository root:
+
+    python -m benchmarks.run --docs 2000 --size 20 --latency 0.005 \\
+        --concurrency 16 --requests 200 --out report.json
+
+The Elasticsearch client behind app.main.es is replaced by
+benchmarks.fake_es.FakeElasticsearch and every endpoint is driven through
+the ASGI app. The JSON report (p50/p95/p99 latency, throughput, peak RSS,
+CSV rows/sec) is meant to be diffed between two versions of the service.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+from benchmarks.fake_es import FakeElasticsearch
+
+DOWNLOAD_OPTIONS = [
+    ("assemblies", "data_portal"),
+    ("annotation", "data_portal"),
+    ("raw_files", "data_portal"),
+    ("metadata", "data_portal"),
+    ("metadata", "tracking_status"),
+]
+
+
+async def asgi_request(app, method, path, query=None, json_body=None,
+                       headers=None):
+    # minimal ASGI client, returns status, headers and the body size
+    body = json.dumps(json_body).encode() if json_body is not None else b""
+    raw_headers = [(b"host", b"benchmark")]
+    if json_body is not None:
+        raw_headers.append((b"content-type", b"application/json"))
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), value.encode()))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path,
+        "raw_path": path.encode(), "root_path": "",
+        "query_string": urlencode(query or {}).encode(),
+        "headers": raw_headers, "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+    }
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(3600)
+            return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    response = {"status": None, "headers": [], "bytes": 0, "lines": 0}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            chunk = message.get("body", b"")
+            response["bytes"] += len(chunk)
+            response["lines"] += chunk.count(b"\n")
+
+    await app(scope, receive, send)
+    return response
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+async def run_scenario(app, name, make_request, requests, concurrency):
+    latencies = list()
+    statuses = dict()
+    rows = 0
+    written = 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal rows, written
+        while not queue.empty():
+            i = queue.get_nowait()
+            started = time.perf_counter()
+            response = await make_request(app, i)
+            latencies.append(time.perf_counter() - started)
+            statuses[response["status"]] = \
+                statuses.get(response["status"], 0) + 1
+            # header line of the CSV is not a row
+            rows += max(response["lines"] - 1, 0)
+            written += response["bytes"]
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    result = {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "throughput_rps": round(requests / elapsed, 1),
+        "bytes_per_request": round(written / requests),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if name.startswith("data-download"):
+        result["rows_per_request"] = round(rows / requests)
+        result["csv_rows_per_sec"] = round(rows / elapsed)
+    return result
+
+
+def peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+
+
+def scenarios(args):
+    def listing(index):
+        async def request(app, i):
+            return await asgi_request(app, "GET", f"/{index}", {
+                "offset": (i * 15) % max(args.docs - 15, 1), "limit": 15})
+        return request
+
+    def details(index, record_id):
+        async def request(app, i):
+            return await asgi_request(app, "GET", f"/{index}/{record_id}")
+        return request
+
+    async def summary(app, i):
+        return await asgi_request(app, "GET", "/summary")
+
+    def download(option, index):
+        async def request(app, i):
+            return await asgi_request(app, "POST", "/data-download",
+                                      json_body={
+                                          "pageIndex": 0, "pageSize": 15,
+                                          "searchValue": "",
+                                          "sortValue": "organism:asc",
+                                          "filterValue": "",
+                                          "currentClass": "kingdom",
+                                          "phylogeny_filters": "",
+                                          "index_name": index,
+                                          "downloadOption": option})
+        return request
+
+    yield "root data_portal", listing("data_portal"), args.requests
+    yield "root tracking_status", listing("tracking_status"), args.requests
+    yield "root articles", listing("articles"), args.requests
+    yield "details data_portal", details("data_portal", "Organism 1"), \
+        args.requests
+    yield "details articles", details("articles", "PRJEB1"), args.requests
+    yield "summary", summary, args.requests
+    for option, index in DOWNLOAD_OPTIONS:
+        yield f"data-download {option} {index}", download(option, index), \
+            args.download_requests
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    # every benchmark request comes from the same client address
+    os.environ.setdefault("EXPORT_RATE_BURST", "1000000")
+    from app import main as service
+
+    fake = FakeElasticsearch.with_synthetic_data(
+        args.docs, args.size, latency=args.latency, jitter=args.jitter)
+    # attached before startup, so the service keeps it instead of
+    # connecting to a cluster
+    service.es.client = fake
+    await service.app.router.startup()
+    try:
+        results = list()
+        for name, make_request, requests in scenarios(args):
+            if args.only and args.only not in name:
+                continue
+            results.append(await run_scenario(
+                service.app, name, make_request, requests,
+                args.concurrency))
+    finally:
+        await service.app.router.shutdown()
+
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "es_requests": fake.requests,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=2000,
+                        help="documents per index")
+    parser.add_argument("--size", type=int, default=20,
+                        help="nested records per data_portal document")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="simulated ES latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="extra random latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--download-requests", type=int, default=4)
+    parser.add_argument("--only", help="run scenarios containing this text")
+    parser.add_argument("--out", help="write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    print(output)